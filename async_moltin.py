@@ -0,0 +1,230 @@
+import asyncio
+import os
+from functools import wraps
+
+import aiohttp
+
+import http_client
+import moltin
+from moltin import DEFAULT_PAGE_LIMIT, MOLTIN_URL
+
+_session = None
+
+
+def get_session():
+    global _session
+    if _session is None or _session.closed:
+        pool_size = int(os.getenv('HTTP_POOL_SIZE', http_client.DEFAULT_POOL_SIZE))
+        moltin_pool_size = http_client.get_pool_sizes().get('api.moltin.com', pool_size)
+        connect_timeout, read_timeout = http_client.get_timeout()
+        connector = aiohttp.TCPConnector(limit_per_host=moltin_pool_size)
+        timeout = aiohttp.ClientTimeout(connect=connect_timeout, sock_read=read_timeout)
+        _session = aiohttp.ClientSession(
+            connector=connector, timeout=timeout, raise_for_status=True
+        )
+    return _session
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+async def get_token():
+    token = moltin.token_manager.get_cached_token()
+    if token is None:
+        loop = asyncio.get_event_loop()
+        token = await loop.run_in_executor(None, moltin.token_manager.get_token)
+    return token
+
+
+def headers_wrapper(func):
+    @wraps(func)
+    async def inner(*args, **kwargs):
+        token = await get_token()
+        try:
+            return await func({'Authorization': f'Bearer {token}'}, *args, **kwargs)
+        except aiohttp.ClientResponseError as error:
+            if error.status != 401:
+                raise
+        loop = asyncio.get_event_loop()
+        await loop.run_in_executor(None, moltin.token_manager.invalidate, token)
+        token = await get_token()
+        return await func({'Authorization': f'Bearer {token}'}, *args, **kwargs)
+
+    return inner
+
+
+_flights = {}
+
+
+def single_flight(func):
+    """Share one in-flight coroutine among concurrent calls with equal args."""
+
+    @wraps(func)
+    async def inner(*args, **kwargs):
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        flight = _flights.get(key)
+        if flight is None:
+            flight = _flights[key] = asyncio.ensure_future(func(*args, **kwargs))
+            flight.add_done_callback(lambda _: _flights.pop(key, None))
+        return await asyncio.shield(flight)
+
+    return inner
+
+
+async def fetch_json(method, url, **kwargs):
+    async with get_session().request(method, url, **kwargs) as response:
+        return await response.json(content_type=None)
+
+
+async def iterate_pages(url, params=None, page_limit=DEFAULT_PAGE_LIMIT):
+    """Yield every item of a Moltin list endpoint, prefetching the next page."""
+    params = {**(params or {}), 'page[limit]': page_limit, 'page[offset]': 0}
+    next_page = asyncio.ensure_future(fetch_page(url, params))
+    while next_page is not None:
+        page = await next_page
+        next_url = moltin.get_next_page_url(page)
+        next_page = asyncio.ensure_future(fetch_page(next_url)) if next_url else None
+        for item in page['data']:
+            yield item
+
+
+@headers_wrapper
+async def fetch_page(headers, url, params=None):
+    return await fetch_json('GET', url, headers=headers, params=params)
+
+
+async def collect(items):
+    return [item async for item in items]
+
+
+async def get_products():
+    products = await collect(iterate_pages(f'{MOLTIN_URL}products'))
+    return [(product['id'], product['name']) for product in products]
+
+
+@single_flight
+@headers_wrapper
+async def get_by_id(headers, product_id):
+    url = f'{MOLTIN_URL}products/{product_id}'
+    response = await fetch_json('GET', url, headers=headers)
+    return response['data']
+
+
+@single_flight
+@headers_wrapper
+async def get_product_with_image(headers, product_id):
+    url = f'{MOLTIN_URL}products/{product_id}'
+    params = {'include': 'main_image'}
+    response = await fetch_json('GET', url, headers=headers, params=params)
+    image_id = moltin.get_main_image_id(response['data'])
+    image_url = moltin.get_included_image_urls(response).get(image_id)
+    return response['data'], image_id, image_url
+
+
+@single_flight
+@headers_wrapper
+async def get_picture(headers, product_id):
+    url = f'{MOLTIN_URL}files/{product_id}'
+    response = await fetch_json('GET', url, headers=headers)
+    return response['data']['link']['href']
+
+
+@headers_wrapper
+async def put_in_cart(headers, reference, product_id, quantity):
+    url = f'{MOLTIN_URL}carts/{reference}/items'
+    data = {'data': {'id': product_id, 'type': 'cart_item', 'quantity': quantity}}
+    response = await fetch_json('POST', url, headers=headers, json=data)
+    return moltin.parse_cart(response)
+
+
+@headers_wrapper
+async def get_cart(headers, reference):
+    url = f'{MOLTIN_URL}carts/{reference}/items'
+    response = await fetch_json('GET', url, headers=headers)
+    return moltin.parse_cart_items(response['data'])
+
+
+@headers_wrapper
+async def get_cart_with_total(headers, reference):
+    url = f'{MOLTIN_URL}carts/{reference}/items'
+    response = await fetch_json('GET', url, headers=headers)
+    return moltin.parse_cart(response)
+
+
+@headers_wrapper
+async def get_total(headers, reference):
+    url = f'{MOLTIN_URL}carts/{reference}'
+    response = await fetch_json('GET', url, headers=headers)
+    return response['data']['meta']['display_price']['with_tax']['formatted']
+
+
+async def format_basket_for_sending(user_id):
+    user_basket, user_total = await asyncio.gather(
+        get_cart(user_id), get_total(user_id)
+    )
+    return moltin.format_basket(user_basket, user_total)
+
+
+@headers_wrapper
+async def delete_item_in_cart(headers, reference, product_id):
+    url = f'{MOLTIN_URL}carts/{reference}/items/{product_id}'
+    response = await fetch_json('DELETE', url, headers=headers)
+    return moltin.parse_cart(response)
+
+
+async def check_product_in_cart(reference, product_id):
+    carts = await get_cart(reference)
+    return moltin.format_in_cart_badge(carts, product_id)
+
+
+@headers_wrapper
+async def create_customer_entry(
+    headers, order_id, customer_name, longitude, latitude, flow_slug='adress'
+):
+    url = f'{MOLTIN_URL}flows/{flow_slug}/entries'
+    data = {
+        'data': {
+            'type': 'entry',
+            'order': order_id,
+            'customer-name': customer_name,
+            'longitude': longitude,
+            'latitude': latitude,
+        }
+    }
+    response = await fetch_json('POST', url, headers=headers, json=data)
+    return response['data']['id']
+
+
+async def get_all_entries(flow_slug):
+    return await collect(iterate_pages(f'{MOLTIN_URL}flows/{flow_slug}/entries'))
+
+
+@headers_wrapper
+async def get_deliverer(headers, entry_id, flow_slug='pizzerias'):
+    url = f'{MOLTIN_URL}flows/{flow_slug}/entries/{entry_id}'
+    response = await fetch_json('GET', url, headers=headers)
+    return response['data']['deliverer']
+
+
+@single_flight
+@headers_wrapper
+async def get_category_by_slug(headers, category_slug):
+    url = f'{MOLTIN_URL}categories'
+    params = {'filter': f'eq(slug,{category_slug})'}
+    response = await fetch_json('GET', url, headers=headers, params=params)
+    category = response['data'][0]
+    products = category['relationships']['products']['data']
+    return {
+        'name': category['name'],
+        'slug': category['slug'],
+        'products': [product['id'] for product in products],
+    }
+
+
+async def get_all_categories():
+    categories = await collect(iterate_pages(f'{MOLTIN_URL}categories'))
+    return [category['slug'] for category in categories]
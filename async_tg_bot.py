@@ -1,3 +1,4 @@
+import asyncio
 import json
 import os
 from textwrap import dedent
@@ -18,15 +19,28 @@ from aiogram.types import (
     ReplyKeyboardRemove,
 )
 from aiogram.utils.emoji import emojize
-from more_itertools import chunked
+from aiogram.utils.exceptions import BadRequest
 
+import async_moltin
 import moltin
 import utils
+from cart_mirror import AsyncCartMirror
+from catalog import AsyncCatalogCache, identity
 from aiogram.types.message import ContentType
 
-storage = RedisStorage2(db=5)
-bot = Bot(token=os.getenv('TG_TOKEN'))
+TG_TOKEN = os.getenv('TG_TOKEN')
+REDIS_HOST = os.getenv('REDIS_URL', 'localhost')
+REDIS_PORT = int(os.getenv('REDIS_PORT', 6379))
+REDIS_PASSWORD = os.getenv('REDIS_PASSWORD')
+
+storage = RedisStorage2(
+    host=REDIS_HOST, port=REDIS_PORT, password=REDIS_PASSWORD, db=5)
+bot = Bot(token=TG_TOKEN)
 dp = Dispatcher(bot=bot, storage=storage)
+redis_pool = None
+geocode_db = None
+catalog = None
+carts = None
 
 
 class BotState(StatesGroup):
@@ -41,8 +55,7 @@ class BotState(StatesGroup):
 
 
 async def get_from_redis(search):
-    redis = await aioredis.create_redis_pool('redis://localhost')
-    return await redis.get(search)
+    return await redis_pool.get(search)
 
 
 async def edit_menu(callback: types.CallbackQuery, state: FSMContext, chunk: int):
@@ -59,43 +72,56 @@ async def edit_menu(callback: types.CallbackQuery, state: FSMContext, chunk: int
 
 
 async def send_detail_message(callback: types.CallbackQuery, state: FSMContext):
-    product = await get_from_redis(callback.data)
+    pizza_data, image_url = await catalog.get_many(
+        [callback.data, f'image_{callback.data}'],
+        parse=[json.loads, identity])
 
-    if product is None:
-        pizza_data = moltin.get_by_id(callback.data)
-    else:
-        pizza_data = json.loads(product)
+    if pizza_data is None:
+        pizza_data = await catalog.get_product(callback.data)
 
     pizza_name = pizza_data['name']
     pizza_text = pizza_data['description']
     pizza_price = pizza_data['meta']['display_price']['with_tax']['formatted']
     image_id = pizza_data['relationships']['main_image']['data']['id']
-    image_url = await get_from_redis(image_id)
-
-    if image_url is None:
-        image = moltin.get_picture(image_id)
-    else:
-        image = image_url
+    photo_key = utils.get_telegram_photo_key(TG_TOKEN, image_id)
+    file_id = await get_from_redis(photo_key)
 
-    basket_message = moltin.check_product_in_cart(
+    basket_message = await carts.check_product(
         callback.from_user.id, callback.data) or ''
     message = f'*{pizza_name}*\n\n{pizza_text}\n\n_Цена {pizza_price}_\n\n{basket_message}'
     keyboard = create_description_buttons()
     await state.update_data(last_product=callback.data)
 
-    return await bot.send_photo(
+    if file_id is not None:
+        try:
+            return await bot.send_photo(
+                chat_id=callback.from_user.id,
+                photo=file_id,
+                caption=message,
+                parse_mode=ParseMode.MARKDOWN,
+                reply_markup=keyboard,
+            )
+        except BadRequest:
+            await redis_pool.delete(photo_key)
+
+    if image_url is None:
+        image_url = await catalog.get_image_url(image_id)
+
+    sent_message = await bot.send_photo(
         chat_id=callback.from_user.id,
-        photo=image.decode('utf-8'),
+        photo=image_url,
         caption=message,
         parse_mode=ParseMode.MARKDOWN,
         reply_markup=keyboard,
     )
+    await redis_pool.set(photo_key, sent_message.photo[-1].file_id)
+    return sent_message
 
 
 async def send_basket_message(callback: types.CallbackQuery, state: FSMContext):
-    keyboard = create_basket_buttons(user_id=callback.from_user.id)
-    message = moltin.format_basket_for_sending(
-        user_id=callback.from_user.id)
+    cart = await carts.get(callback.from_user.id)
+    keyboard = create_basket_buttons(cart['items'], cart['total'])
+    message = moltin.format_basket(cart['items'], cart['total'])
     return await bot.send_message(
         chat_id=callback.from_user.id,
         text=message,
@@ -104,20 +130,17 @@ async def send_basket_message(callback: types.CallbackQuery, state: FSMContext):
     )
 
 
-async def create_menu_buttons(chunk=0):
-    products = await get_from_redis('products')
-    chunks = list(chunked(json.loads(products), 7))
-
+def build_menu_page(products, chunk, last_chunk):
     keyboard = InlineKeyboardMarkup(row_width=1)
     buttons = (InlineKeyboardButton(pr_name, callback_data=pr_id)
-               for pr_id, pr_name in chunks[chunk])
+               for pr_id, pr_name in products)
     next_button = InlineKeyboardButton('Следующие ➡️', callback_data='next')
     prev_button = InlineKeyboardButton('⬅️ Предыдущие', callback_data='prev')
     keyboard.add(*buttons)
 
     if chunk == 0:
         keyboard.add(next_button)
-    elif chunk == len(chunks) - 1:
+    elif chunk == last_chunk:
         keyboard.add(prev_button)
     else:
         keyboard.row(*(prev_button, next_button))
@@ -126,6 +149,14 @@ async def create_menu_buttons(chunk=0):
     return keyboard
 
 
+menu_pages = utils.MenuPages(build_menu_page, size=7)
+
+
+async def create_menu_buttons(chunk=0):
+    products = await catalog.get_products()
+    return menu_pages.get_page(products, chunk)
+
+
 def create_description_buttons():
     keyboard = InlineKeyboardMarkup(row_width=1)
     buttons_list = [['1 шт', 'cart 1'], ['3 шт', 'cart 3'], ['5 шт', 'cart 5']]
@@ -140,9 +171,7 @@ def create_description_buttons():
     return keyboard
 
 
-def create_basket_buttons(user_id):
-    basket = moltin.get_cart(user_id)
-    total = moltin.get_total(user_id)
+def create_basket_buttons(basket, total):
     keyboard = InlineKeyboardMarkup(row_width=1)
     buttons = (
         InlineKeyboardButton(
@@ -163,7 +192,7 @@ def create_basket_buttons(user_id):
 
 def create_delivery_buttons(distance):
     keyboard = InlineKeyboardMarkup(row_width=1)
-    if distance < 20:
+    if utils.get_delivery_price(distance) is not None:
         buttons = (
             InlineKeyboardButton('Доставка', callback_data='delivery'),
             InlineKeyboardButton('Самовывоз', callback_data='pickup'),
@@ -245,7 +274,7 @@ async def handle_desciption(callback: types.CallbackQuery, state: FSMContext):
         await bot.delete_message(chat_id=callback.from_user.id, message_id=callback.message.message_id)
     elif 'cart' in callback.data:
         quantity = int(callback.data.split()[1])
-        moltin.put_in_cart(callback.from_user.id, product, quantity)
+        carts.queue_put(callback.from_user.id, product, quantity)
         await callback.answer(emojize('Добавили :pizza: в 🛒 !'))
         await BotState.description.set()
 
@@ -266,7 +295,7 @@ async def handle_basket(callback: types.CallbackQuery, state: FSMContext):
         await bot.delete_message(chat_id=callback.from_user.id, message_id=callback.message.message_id)
         await BotState.geo.set()
     else:
-        moltin.delete_item_in_cart(callback.from_user.id, callback.data)
+        await carts.delete(callback.from_user.id, callback.data)
         await callback.answer('Удалили :pizza: из 🛒!')
         await send_basket_message(callback, state)
         await bot.delete_message(chat_id=callback.from_user.id, message_id=callback.message.message_id)
@@ -282,7 +311,9 @@ async def handle_geo(message: types.Message, state: FSMContext):
         location = (user_location['longitude'], user_location['latitude'])
     else:
         try:
-            location = utils.fetch_coordinates(message.text)
+            location = await asyncio.get_event_loop().run_in_executor(
+                None, utils.fetch_coordinates, message.text, geocode_db
+            )
         except IndexError:
             location = None
 
@@ -290,9 +321,9 @@ async def handle_geo(message: types.Message, state: FSMContext):
             await message.answer(emojize('Не смогли определить адрес :house:, попробуйте еще.'))
             await BotState.geo.set()
 
-    all_pizzerias = await get_from_redis('pizzerias')
+    all_pizzerias = await catalog.get_pizzerias()
     closest_pizzeria = utils.get_closest_pizzeria(
-        location, all_pizzerias=json.loads(all_pizzerias))
+        location, all_pizzerias=all_pizzerias)
     reply_message, distance = utils.calculate_distance_for_message(
         closest_pizzeria)
 
@@ -367,7 +398,7 @@ async def handle_pay(callback: types.CallbackQuery, state: FSMContext):
             message_id=callback.message.message_id,
         )
     elif callback.data == 'telegram':
-        total = moltin.get_total(callback.from_user.id)
+        total = await carts.get_total(callback.from_user.id)
         amount = total.split()[0].split('.')[0].replace(',', '')
         payload = os.getenv('PAYMENT_PAYLOAD')
         provider_token = os.getenv('TG_TRANZZO_TOKEN')
@@ -388,5 +419,28 @@ async def handle_pay(callback: types.CallbackQuery, state: FSMContext):
         await bot.delete_message(chat_id=callback.from_user.id, message_id=callback.message.message_id)
 
 
+async def on_startup(dispatcher: Dispatcher):
+    global redis_pool, geocode_db, catalog, carts
+    redis_pool = await aioredis.create_redis_pool(
+        (REDIS_HOST, REDIS_PORT),
+        password=REDIS_PASSWORD,
+        encoding='utf-8',
+    )
+    catalog = AsyncCatalogCache(redis_pool)
+    catalog.start_listening()
+    carts = AsyncCartMirror(redis_pool)
+    geocode_db = utils.get_database()
+
+
+async def on_shutdown(dispatcher: Dispatcher):
+    await carts.flush_all()
+    await catalog.stop_listening()
+    await async_moltin.close_session()
+    redis_pool.close()
+    await redis_pool.wait_closed()
+
+
 if __name__ == '__main__':
-    executor.start_polling(dp, skip_updates=True)
+    executor.start_polling(
+        dp, skip_updates=True, on_startup=on_startup, on_shutdown=on_shutdown
+    )
@@ -0,0 +1,184 @@
+import asyncio
+import logging
+import os
+
+import aiohttp
+from dotenv import load_dotenv
+from vk_api.exceptions import ApiError
+from vk_api.vk_api import VkApiMethod
+
+import utils
+import vk_bot
+from cart_mirror import CartMirror
+from catalog import CatalogCache
+from worker_pool import DEFAULT_QUEUE_SIZE, DEFAULT_WORKERS, OrderedWorkerPool
+
+VK_API_URL = 'https://api.vk.com/method/'
+VK_API_VERSION = '5.103'
+VK_API_TIMEOUT = 10
+LONG_POLL_WAIT = 25
+LONG_POLL_RETRY_INTERVAL = 1
+DEFAULT_HTTP_POOL_SIZE = 20
+
+
+class AsyncVkApi:
+    """VK API and Bots Long Poll client on one pooled aiohttp session."""
+
+    def __init__(self, token, pool_size=DEFAULT_HTTP_POOL_SIZE):
+        self.token = token
+        self.pool_size = pool_size
+        self._session = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=VK_API_TIMEOUT),
+            )
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+        self._session = None
+
+    async def call(self, method, **params):
+        data = {key: value for key, value in params.items() if value is not None}
+        data.update(access_token=self.token, v=VK_API_VERSION)
+        async with self.session.post(f'{VK_API_URL}{method}', data=data) as response:
+            content = await response.json(content_type=None)
+        if 'error' in content:
+            raise ApiError(self, method, params, False, content['error'])
+        return content['response']
+
+    async def get_long_poll_server(self, group_id):
+        """Ask for a Long Poll server until VK answers, pausing between tries."""
+        while True:
+            try:
+                return await self.call('groups.getLongPollServer', group_id=group_id)
+            except (ApiError, aiohttp.ClientError, asyncio.TimeoutError) as error:
+                logging.warning(error)
+                await asyncio.sleep(LONG_POLL_RETRY_INTERVAL)
+
+    async def listen(self, group_id):
+        """Yield Bots Long Poll updates, renewing the server key when needed."""
+        server = await self.get_long_poll_server(group_id)
+        timeout = aiohttp.ClientTimeout(total=LONG_POLL_WAIT + 10)
+        while True:
+            params = {
+                'act': 'a_check',
+                'key': server['key'],
+                'ts': server['ts'],
+                'wait': LONG_POLL_WAIT,
+            }
+            try:
+                async with self.session.get(
+                    server['server'], params=params, timeout=timeout
+                ) as response:
+                    content = await response.json(content_type=None)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as error:
+                logging.warning(error)
+                await asyncio.sleep(LONG_POLL_RETRY_INTERVAL)
+                continue
+
+            failed = content.get('failed')
+            if failed == 1:
+                server['ts'] = content['ts']
+                continue
+            if failed:
+                server = await self.get_long_poll_server(group_id)
+                continue
+
+            server['ts'] = content['ts']
+            for update in content['updates']:
+                yield update
+
+
+class ThreadBridge:
+    """Lets the sync vk_bot handlers call AsyncVkApi from worker threads.
+
+    Wrapped in VkApiMethod it looks like `vk_session.get_api()`, so
+    `vk.messages.send(...)` and VkUpload keep working unchanged.
+    """
+
+    def __init__(self, api, loop):
+        self.api = api
+        self.loop = loop
+
+    def method(self, method, values=None):
+        call = self.api.call(method, **(values or {}))
+        return asyncio.run_coroutine_threadsafe(call, self.loop).result()
+
+
+class MessageEvent:
+    """VkLongPoll-like event built from a Bots Long Poll `message_new` object.
+
+    As with VkLongPoll, `payload` is only set when the message has one.
+    """
+
+    def __init__(self, message):
+        self.user_id = message['from_id']
+        self.text = message.get('text', '')
+        self.message = self.text
+        self.extra_values = {}
+        if message.get('payload'):
+            self.payload = message['payload']
+            self.extra_values['payload'] = message['payload']
+
+
+async def run_bot(api, group_id, workers):
+    """Feed `message_new` updates to the sync handlers on `workers`.
+
+    submit() blocks while a worker's queue is full, so it runs in the
+    default executor and the loop stays free for the handlers' API calls.
+    """
+    loop = asyncio.get_event_loop()
+    vk = VkApiMethod(ThreadBridge(api, loop))
+    try:
+        async for update in api.listen(group_id):
+            if update['type'] != 'message_new':
+                continue
+            message = update['object']['message']
+            if message['from_id'] <= 0:
+                continue
+            event = MessageEvent(message)
+            await loop.run_in_executor(None, workers.submit, event.user_id, event, vk)
+    finally:
+        await loop.run_in_executor(None, workers.stop)
+        await api.close()
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+
+    vk_bot.db = utils.get_database()
+    vk_bot.catalog = CatalogCache(vk_bot.db)
+    vk_bot.carts = CartMirror(vk_bot.db)
+    vk_bot.catalog.start_listening()
+
+    api = AsyncVkApi(
+        os.getenv("VK_TOKEN"),
+        pool_size=int(os.getenv("VK_HTTP_POOL_SIZE", DEFAULT_HTTP_POOL_SIZE)),
+    )
+    workers = OrderedWorkerPool(
+        vk_bot.handle_user_reply,
+        workers=int(os.getenv("VK_WORKERS", DEFAULT_WORKERS)),
+        queue_size=int(os.getenv("VK_QUEUE_SIZE", DEFAULT_QUEUE_SIZE)),
+    )
+    workers.start()
+    workers.log_stats_every(
+        int(os.getenv("VK_STATS_INTERVAL", vk_bot.DEFAULT_STATS_INTERVAL))
+    )
+    try:
+        asyncio.get_event_loop().run_until_complete(
+            run_bot(
+                api,
+                group_id=int(os.getenv("VK_GROUP_ID", vk_bot.VK_GRROUP_ID)),
+                workers=workers,
+            )
+        )
+    finally:
+        vk_bot.carts.flush_all()
@@ -0,0 +1,382 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from contextlib import asynccontextmanager, contextmanager
+
+import aiohttp
+import requests
+
+import async_moltin
+import moltin
+
+CART_TTL = 7 * 24 * 60 * 60
+DEFAULT_CART_SYNC_INTERVAL = 300
+DEFAULT_CART_WRITE_DELAY = 1.5
+MAX_CART_WRITE_RETRIES = 5
+
+
+def get_cart_key(reference):
+    return f'cart_{reference}'
+
+
+def get_sync_interval():
+    return int(os.getenv('CART_SYNC_INTERVAL', DEFAULT_CART_SYNC_INTERVAL))
+
+
+def get_write_delay():
+    return float(os.getenv('CART_WRITE_DELAY', DEFAULT_CART_WRITE_DELAY))
+
+
+def dump_cart(cart):
+    return json.dumps({**cart, 'synced_at': time.time()})
+
+
+def is_transient_error(error):
+    """Whether a failed Moltin write may succeed if it is sent again later."""
+    if isinstance(
+        error,
+        (
+            requests.ConnectionError,
+            requests.Timeout,
+            aiohttp.ClientConnectionError,
+            asyncio.TimeoutError,
+        ),
+    ):
+        return True
+    if isinstance(error, aiohttp.ClientResponseError):
+        status = error.status
+    else:
+        status = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status is not None and (status == 429 or status >= 500)
+
+
+def get_retry_delay(attempt):
+    return get_write_delay() * 2 ** attempt
+
+
+def log_dropped_item(reference, product_id, quantity, error):
+    logging.error(
+        'Dropped %s x %s queued for cart %s: %s', quantity, product_id, reference, error
+    )
+
+
+def load_fresh_cart(cached):
+    """Return the mirrored cart, or None when it has to be reconciled."""
+    if cached is None:
+        return None
+    cart = json.loads(cached)
+    if cart.get('total') is None:
+        return None
+    if time.time() - cart.get('synced_at', 0) > get_sync_interval():
+        return None
+    return cart
+
+
+class CartMirror:
+    """Per-user copy of the Moltin cart kept in Redis.
+
+    The mirror is written through from the responses of cart mutations and
+    re-read from Moltin when it is missing or older than CART_SYNC_INTERVAL.
+
+    Additions made with queue_put are held for CART_WRITE_DELAY seconds and
+    quantities for the same product are summed into one Moltin write. Every
+    other operation on the cart flushes them first, so reads, deletes and
+    checkout always see the additions made before them.
+
+    A write that fails with a transient error stays queued and is retried
+    with a doubling delay, up to MAX_CART_WRITE_RETRIES times in a row. Any
+    other failed write is dropped and logged, so one bad item can't block
+    the cart.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._pending = {}
+        self._timers = {}
+        self._retries = {}
+        self._lock = threading.Lock()
+        self._cart_locks = defaultdict(threading.Lock)
+
+    def save(self, reference, cart):
+        if cart['total'] is None:
+            cart = moltin.get_cart_with_total(reference)
+        self.db.set(get_cart_key(reference), dump_cart(cart), ex=CART_TTL)
+        return cart
+
+    def reconcile(self, reference):
+        return self.save(reference, moltin.get_cart_with_total(reference))
+
+    def queue_put(self, reference, product_id, quantity):
+        with self._lock:
+            pending = self._pending.setdefault(reference, {})
+            pending[product_id] = pending.get(product_id, 0) + quantity
+        self._schedule(reference)
+
+    def _schedule(self, reference, delay=None):
+        with self._lock:
+            if reference in self._timers or reference not in self._pending:
+                return
+            timer = threading.Timer(
+                delay or get_write_delay(), self._try_flush, [reference]
+            )
+            timer.daemon = True
+            self._timers[reference] = timer
+        timer.start()
+
+    def _try_flush(self, reference):
+        try:
+            self.flush(reference)
+        except Exception as error:
+            logging.exception(error)
+
+    @contextmanager
+    def _locked_cart(self, reference):
+        while True:
+            with self._lock:
+                cart_lock = self._cart_locks[reference]
+            cart_lock.acquire()
+            with self._lock:
+                if self._cart_locks.get(reference) is cart_lock:
+                    break
+            cart_lock.release()
+        try:
+            yield
+        finally:
+            with self._lock:
+                if reference not in self._pending:
+                    del self._cart_locks[reference]
+                    self._retries.pop(reference, None)
+            cart_lock.release()
+
+    def _forget(self, reference, product_id, quantity):
+        with self._lock:
+            pending = self._pending[reference]
+            pending[product_id] -= quantity
+            if not pending[product_id]:
+                del pending[product_id]
+            if not pending:
+                del self._pending[reference]
+
+    def _retry_later(self, reference):
+        """Schedule another flush, or return False once the retries are spent."""
+        with self._lock:
+            attempt = self._retries.get(reference, 0)
+            if attempt >= MAX_CART_WRITE_RETRIES:
+                return False
+            self._retries[reference] = attempt + 1
+        self._schedule(reference, get_retry_delay(attempt))
+        return True
+
+    def _should_retry(self, reference, product_id, quantity, error):
+        if is_transient_error(error) and self._retry_later(reference):
+            logging.warning('Cart %s write failed: %s', reference, error)
+            return True
+        log_dropped_item(reference, product_id, quantity, error)
+        return False
+
+    def flush(self, reference):
+        """Write the queued additions, dropping each one once Moltin has it.
+
+        Stops at the first transient failure and leaves the rest queued for a
+        retry; other failures drop the item and go on with the next one.
+        """
+        with self._locked_cart(reference):
+            with self._lock:
+                pending = dict(self._pending.get(reference, {}))
+                timer = self._timers.pop(reference, None)
+            if timer is not None:
+                timer.cancel()
+            cart = None
+            try:
+                for product_id, quantity in pending.items():
+                    try:
+                        cart = moltin.put_in_cart(reference, product_id, quantity)
+                    except Exception as error:
+                        if self._should_retry(reference, product_id, quantity, error):
+                            return
+                    else:
+                        with self._lock:
+                            self._retries.pop(reference, None)
+                    self._forget(reference, product_id, quantity)
+            finally:
+                if cart is not None:
+                    self.save(reference, cart)
+
+    def flush_all(self):
+        for reference in list(self._pending):
+            self._try_flush(reference)
+
+    def get(self, reference):
+        self._try_flush(reference)
+        cart = load_fresh_cart(self.db.get(get_cart_key(reference)))
+        if cart is None:
+            cart = self.reconcile(reference)
+        return cart
+
+    def put(self, reference, product_id, quantity):
+        self._try_flush(reference)
+        cart = moltin.put_in_cart(reference, product_id, quantity)
+        return self.save(reference, cart)
+
+    def delete(self, reference, cart_item_id):
+        self._try_flush(reference)
+        cart = moltin.delete_item_in_cart(reference, cart_item_id)
+        return self.save(reference, cart)
+
+    def get_total(self, reference):
+        return self.get(reference)['total']
+
+    def format_basket(self, reference):
+        cart = self.get(reference)
+        return moltin.format_basket(cart['items'], cart['total'])
+
+    def check_product(self, reference, product_id):
+        return moltin.format_in_cart_badge(self.get(reference)['items'], product_id)
+
+
+class AsyncCartMirror:
+    """Asyncio flavour of CartMirror on top of an aioredis pool."""
+
+    def __init__(self, redis_pool):
+        self.redis = redis_pool
+        self._pending = {}
+        self._flushers = {}
+        self._retries = {}
+        self._cart_locks = defaultdict(asyncio.Lock)
+
+    async def save(self, reference, cart):
+        if cart['total'] is None:
+            cart = await async_moltin.get_cart_with_total(reference)
+        await self.redis.set(
+            get_cart_key(reference), dump_cart(cart), expire=CART_TTL
+        )
+        return cart
+
+    async def reconcile(self, reference):
+        cart = await async_moltin.get_cart_with_total(reference)
+        return await self.save(reference, cart)
+
+    def queue_put(self, reference, product_id, quantity):
+        pending = self._pending.setdefault(reference, {})
+        pending[product_id] = pending.get(product_id, 0) + quantity
+        self._schedule(reference)
+
+    def _schedule(self, reference, delay=None):
+        if reference in self._flushers or reference not in self._pending:
+            return
+        self._flushers[reference] = asyncio.ensure_future(
+            self._flush_later(reference, delay or get_write_delay())
+        )
+
+    async def _flush_later(self, reference, delay):
+        await asyncio.sleep(delay)
+        await self._try_flush(reference)
+
+    async def _try_flush(self, reference):
+        try:
+            await self.flush(reference)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            logging.exception(error)
+
+    def _retry_later(self, reference):
+        attempt = self._retries.get(reference, 0)
+        if attempt >= MAX_CART_WRITE_RETRIES:
+            return False
+        self._retries[reference] = attempt + 1
+        self._schedule(reference, get_retry_delay(attempt))
+        return True
+
+    def _should_retry(self, reference, product_id, quantity, error):
+        if is_transient_error(error) and self._retry_later(reference):
+            logging.warning('Cart %s write failed: %s', reference, error)
+            return True
+        log_dropped_item(reference, product_id, quantity, error)
+        return False
+
+    @asynccontextmanager
+    async def _locked_cart(self, reference):
+        while True:
+            cart_lock = self._cart_locks[reference]
+            await cart_lock.acquire()
+            if self._cart_locks.get(reference) is cart_lock:
+                break
+            cart_lock.release()
+        try:
+            yield
+        finally:
+            if reference not in self._pending:
+                del self._cart_locks[reference]
+                self._retries.pop(reference, None)
+            cart_lock.release()
+
+    def _forget(self, reference, product_id, quantity):
+        pending = self._pending[reference]
+        pending[product_id] -= quantity
+        if not pending[product_id]:
+            del pending[product_id]
+        if not pending:
+            del self._pending[reference]
+
+    async def flush(self, reference):
+        async with self._locked_cart(reference):
+            pending = dict(self._pending.get(reference, {}))
+            flusher = self._flushers.pop(reference, None)
+            if flusher is not None and flusher is not asyncio.current_task():
+                flusher.cancel()
+            cart = None
+            try:
+                for product_id, quantity in pending.items():
+                    try:
+                        cart = await async_moltin.put_in_cart(
+                            reference, product_id, quantity
+                        )
+                    except Exception as error:
+                        if self._should_retry(reference, product_id, quantity, error):
+                            return
+                    else:
+                        self._retries.pop(reference, None)
+                    self._forget(reference, product_id, quantity)
+            finally:
+                if cart is not None:
+                    await self.save(reference, cart)
+
+    async def flush_all(self):
+        await asyncio.gather(
+            *(self._try_flush(reference) for reference in list(self._pending))
+        )
+        for flusher in self._flushers.values():
+            flusher.cancel()
+
+    async def get(self, reference):
+        await self._try_flush(reference)
+        cart = load_fresh_cart(await self.redis.get(get_cart_key(reference)))
+        if cart is None:
+            cart = await self.reconcile(reference)
+        return cart
+
+    async def put(self, reference, product_id, quantity):
+        await self._try_flush(reference)
+        cart = await async_moltin.put_in_cart(reference, product_id, quantity)
+        return await self.save(reference, cart)
+
+    async def delete(self, reference, cart_item_id):
+        await self._try_flush(reference)
+        cart = await async_moltin.delete_item_in_cart(reference, cart_item_id)
+        return await self.save(reference, cart)
+
+    async def get_total(self, reference):
+        return (await self.get(reference))['total']
+
+    async def format_basket(self, reference):
+        cart = await self.get(reference)
+        return moltin.format_basket(cart['items'], cart['total'])
+
+    async def check_product(self, reference, product_id):
+        cart = await self.get(reference)
+        return moltin.format_in_cart_badge(cart['items'], product_id)
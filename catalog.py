@@ -0,0 +1,368 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import redis
+
+import async_moltin
+import moltin
+from invalidation import INVALIDATION_CHANNEL
+
+DEFAULT_L1_SIZE = 1024
+DEFAULT_L1_TTL = 60
+LISTEN_RETRY_INTERVAL = 1
+LOAD_LOCK_TIMEOUT = 5
+LOAD_POLL_INTERVAL = 0.05
+
+
+def identity(value):
+    return value
+
+
+def get_load_lock_key(key):
+    return f'loading_{key}'
+
+
+class LocalCache:
+    """Bounded in-process LRU of parsed catalog records with per-tier stats.
+
+    Cached values are shared between callers and must not be mutated. Entries
+    live for at most `ttl` seconds, so a missed invalidation message can only
+    leave a record stale for that long.
+    """
+
+    def __init__(self, max_size=DEFAULT_L1_SIZE, ttl=DEFAULT_L1_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._stats = {'l1_hits': 0, 'l2_hits': 0, 'misses': 0}
+
+    def _get_local(self, key):
+        with self._lock:
+            if key not in self._items:
+                return False, None
+            expires_at, value = self._items[key]
+            if expires_at < time.monotonic():
+                del self._items[key]
+                return False, None
+            self._items.move_to_end(key)
+            self._stats['l1_hits'] += 1
+            return True, value
+
+    def _get_generation(self):
+        with self._lock:
+            return self._generation
+
+    def _put_local(self, key, value, generation=None):
+        """Store `value` unless an invalidation arrived since `generation`."""
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def _count(self, tier):
+        with self._lock:
+            self._stats[tier] += 1
+
+    def invalidate(self, keys):
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._items.clear()
+
+    def handle_invalidation(self, data):
+        try:
+            keys = json.loads(data)
+        except ValueError as error:
+            logging.error(error)
+            self.clear()
+            return
+        self.invalidate(keys)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['l1_size'] = len(self._items)
+        lookups = stats['l1_hits'] + stats['l2_hits'] + stats['misses']
+        for tier in ('l1', 'l2'):
+            hits = stats[f'{tier}_hits']
+            stats[f'{tier}_hit_ratio'] = hits / lookups if lookups else 0
+        return stats
+
+
+class CatalogCache(LocalCache):
+    """Read-through catalog cache: process memory, then Redis, then Moltin.
+
+    Concurrent misses on the same key are loaded once: threads share one call
+    and processes take a short Redis lock, while the others wait for the
+    winner to write the key.
+    """
+
+    def __init__(self, db, max_size=DEFAULT_L1_SIZE, ttl=DEFAULT_L1_TTL):
+        super().__init__(max_size, ttl)
+        self.db = db
+        self._flights = moltin.SingleFlight()
+
+    def start_listening(self):
+        listener = threading.Thread(
+            target=self._listen, name='catalog-invalidation', daemon=True
+        )
+        listener.start()
+        return listener
+
+    def _listen(self):
+        """Follow INVALIDATION_CHANNEL, resubscribing after connection errors.
+
+        Messages published while the subscription was down are lost, so L1 is
+        cleared every time it is (re)established.
+        """
+        while True:
+            pubsub = self.db.pubsub(ignore_subscribe_messages=True)
+            try:
+                pubsub.subscribe(**{INVALIDATION_CHANNEL: self._on_message})
+                self.clear()
+                for _ in pubsub.listen():
+                    pass
+            except redis.RedisError as error:
+                logging.warning('Invalidation listener: %s', error)
+            finally:
+                pubsub.close()
+            self.clear()
+            time.sleep(LISTEN_RETRY_INTERVAL)
+
+    def _on_message(self, message):
+        self.handle_invalidation(message['data'])
+
+    def get(self, key, loader=None, parse=json.loads, dump=json.dumps):
+        found, value = self._get_local(key)
+        if found:
+            return value
+
+        generation = self._get_generation()
+        cached = self.db.get(key)
+        if cached is not None:
+            self._count('l2_hits')
+            value = parse(cached)
+        elif loader is not None:
+            self._count('misses')
+            value = self._flights.do(key, self._load, key, loader, parse, dump)
+        else:
+            self._count('misses')
+            return None
+
+        self._put_local(key, value, generation)
+        return value
+
+    def _load(self, key, loader, parse, dump):
+        lock_key = get_load_lock_key(key)
+        locked = self.db.set(lock_key, os.getpid(), nx=True, ex=LOAD_LOCK_TIMEOUT)
+        try:
+            cached = self.db.get(key) if locked else self._wait_for(key)
+            if cached is not None:
+                return parse(cached)
+            value = loader()
+            self.db.set(key, dump(value))
+            return value
+        finally:
+            if locked:
+                self.db.delete(lock_key)
+
+    def _wait_for(self, key):
+        deadline = time.monotonic() + LOAD_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            time.sleep(LOAD_POLL_INTERVAL)
+            cached = self.db.get(key)
+            if cached is not None:
+                return cached
+        return None
+
+    def _load_product(self, product_id):
+        product, image_id, image_url = moltin.get_product_with_image(product_id)
+        if image_id is not None:
+            self.db.mset({image_id: image_url, f'image_{product_id}': image_url})
+            self._put_local(image_id, image_url)
+            self._put_local(f'image_{product_id}', image_url)
+        return product
+
+    def get_product(self, product_id):
+        return self.get(product_id, lambda: self._load_product(product_id))
+
+    def get_category(self, slug):
+        return self.get(slug, lambda: moltin.get_category_by_slug(slug))
+
+    def get_image_url(self, image_id):
+        return self.get(
+            image_id,
+            lambda: moltin.get_picture(image_id),
+            parse=identity,
+            dump=identity,
+        )
+
+    def get_products(self):
+        return self.get('products', moltin.get_products)
+
+    def get_categories(self):
+        return self.get('categories', moltin.get_all_categories)
+
+
+class AsyncCatalogCache(LocalCache):
+    """Asyncio flavour of CatalogCache on top of an aioredis pool."""
+
+    def __init__(self, redis_pool, max_size=DEFAULT_L1_SIZE, ttl=DEFAULT_L1_TTL):
+        super().__init__(max_size, ttl)
+        self.redis = redis_pool
+        self._listener = None
+        self._flights = {}
+
+    async def _listen(self):
+        while True:
+            try:
+                channel, = await self.redis.subscribe(INVALIDATION_CHANNEL)
+                self.clear()
+                async for data in channel.iter(encoding='utf-8'):
+                    self.handle_invalidation(data)
+            except asyncio.CancelledError:
+                raise
+            except Exception as error:
+                logging.warning('Invalidation listener: %s', error)
+            self.clear()
+            await asyncio.sleep(LISTEN_RETRY_INTERVAL)
+
+    def start_listening(self):
+        self._listener = asyncio.ensure_future(self._listen())
+        return self._listener
+
+    async def stop_listening(self):
+        if self._listener is not None:
+            self._listener.cancel()
+            await self.redis.unsubscribe(INVALIDATION_CHANNEL)
+
+    async def get_many(self, keys, parse=json.loads):
+        """Look up several keys with a single MGET for the ones missing in L1.
+
+        `parse` may be a single function or one function per key. Keys missing
+        in Redis come back as None and are not counted, as the caller is
+        expected to load them with get().
+        """
+        parsers = parse if isinstance(parse, (list, tuple)) else [parse] * len(keys)
+        generation = self._get_generation()
+        values = {}
+        missing = []
+        for key in keys:
+            found, value = self._get_local(key)
+            if found:
+                values[key] = value
+            else:
+                missing.append(key)
+
+        if missing:
+            parsers_by_key = dict(zip(keys, parsers))
+            for key, cached in zip(missing, await self.redis.mget(*missing)):
+                if cached is None:
+                    values[key] = None
+                    continue
+                self._count('l2_hits')
+                values[key] = parsers_by_key[key](cached)
+                self._put_local(key, values[key], generation)
+        return [values[key] for key in keys]
+
+    async def get(self, key, loader=None, parse=json.loads, dump=json.dumps):
+        found, value = self._get_local(key)
+        if found:
+            return value
+
+        generation = self._get_generation()
+        cached = await self.redis.get(key)
+        if cached is not None:
+            self._count('l2_hits')
+            value = parse(cached)
+        elif loader is not None:
+            self._count('misses')
+            value = await self._load_once(key, loader, parse, dump)
+        else:
+            self._count('misses')
+            return None
+
+        self._put_local(key, value, generation)
+        return value
+
+    async def _load_once(self, key, loader, parse, dump):
+        flight = self._flights.get(key)
+        if flight is None:
+            flight = asyncio.ensure_future(self._load(key, loader, parse, dump))
+            self._flights[key] = flight
+            flight.add_done_callback(lambda _: self._flights.pop(key, None))
+        return await asyncio.shield(flight)
+
+    async def _load(self, key, loader, parse, dump):
+        lock_key = get_load_lock_key(key)
+        locked = await self.redis.set(
+            lock_key,
+            os.getpid(),
+            expire=LOAD_LOCK_TIMEOUT,
+            exist=self.redis.SET_IF_NOT_EXIST,
+        )
+        try:
+            cached = await (self.redis.get(key) if locked else self._wait_for(key))
+            if cached is not None:
+                return parse(cached)
+            value = await loader()
+            await self.redis.set(key, dump(value))
+            return value
+        finally:
+            if locked:
+                await self.redis.delete(lock_key)
+
+    async def _wait_for(self, key):
+        deadline = time.monotonic() + LOAD_LOCK_TIMEOUT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(LOAD_POLL_INTERVAL)
+            cached = await self.redis.get(key)
+            if cached is not None:
+                return cached
+        return None
+
+    async def _load_product(self, product_id):
+        product, image_id, image_url = await async_moltin.get_product_with_image(
+            product_id
+        )
+        if image_id is not None:
+            await self.redis.mset(
+                image_id, image_url, f'image_{product_id}', image_url
+            )
+            self._put_local(image_id, image_url)
+            self._put_local(f'image_{product_id}', image_url)
+        return product
+
+    async def get_product(self, product_id):
+        return await self.get(product_id, lambda: self._load_product(product_id))
+
+    async def get_image_url(self, image_id):
+        return await self.get(
+            image_id,
+            lambda: async_moltin.get_picture(image_id),
+            parse=identity,
+            dump=identity,
+        )
+
+    async def get_products(self):
+        return await self.get('products', async_moltin.get_products)
+
+    async def get_pizzerias(self):
+        return await self.get(
+            'pizzerias', lambda: async_moltin.get_all_entries('pizzerias')
+        )
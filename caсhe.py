@@ -1,44 +1,231 @@
+import argparse
 import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
 import redis
+import requests
+import telegram
+import vk_api
 from dotenv import load_dotenv
+from vk_api.exceptions import ApiError
 
+import invalidation
 import moltin
+import photos
 from utils import get_database
 
+DEFAULT_WORKERS = 8
+DEFAULT_SYNC_INTERVAL = 300
+WATERMARKS_KEY = 'catalog_watermarks'
+
+
+@contextmanager
+def timed(phase, timings):
+    started_at = time.monotonic()
+    yield
+    timings[phase] = time.monotonic() - started_at
+    logging.info('%s cached in %.2f s', phase, timings[phase])
+
+
+def run_timed(phase, timings, func, *args):
+    with timed(phase, timings):
+        return func(*args)
+
+
+def get_updated_at(item):
+    return item.get('meta', {}).get('timestamps', {}).get('updated_at', '')
+
+
+def get_watermark(items, watermark=''):
+    return max([watermark, *(get_updated_at(item) for item in items)])
+
+
+def cache_categories(db, executor, changed_since=None):
+    """Cache categories, re-fetching only those changed after `changed_since`.
+
+    Category details are requested while the next list page is still loading.
+    With `changed_since=None` every category is fetched. Returns the newest
+    `updated_at` seen, to be used as the next watermark.
+    """
+    cached_list = db.get('categories')
+    cached_slugs = set(json.loads(cached_list or '[]'))
+    categories = []
+    changed = {}
+    for category in moltin.iterate_categories(prefetch=True):
+        categories.append(category)
+        slug = category['slug']
+        if (
+            changed_since is None
+            or get_updated_at(category) > changed_since
+            or slug not in cached_slugs
+        ):
+            changed[slug] = executor.submit(moltin.get_category_by_slug, slug)
+    slugs = [category['slug'] for category in categories]
 
-def cache_categories(db):
-    categories = moltin.get_all_categories()
-    db.set('categories', json.dumps(categories))
-    for slug in categories:
-        category_data = moltin.get_category_by_slug(slug)
-        db.set(slug, json.dumps(category_data))
+    values = {slug: json.dumps(data.result()) for slug, data in changed.items()}
+    if json.dumps(slugs) != cached_list:
+        values['categories'] = json.dumps(slugs)
+    if values:
+        db.mset(values)
 
+    removed = cached_slugs - set(slugs)
+    if removed:
+        db.delete(*removed)
+    invalidation.publish_invalidation(db, set(values) | removed)
+    return get_watermark(categories, changed_since or '')
 
-def cache_products(db):
-    products_data = moltin.get_products()
-    product_idies = [product_id for product_id, product_name in products_data]
-    db.set('products', json.dumps(products_data))
-    for product_id in product_idies:
-        product = moltin.get_by_id(product_id)
-        image_id = product['relationships']['main_image']['data']['id']
-        image_url = moltin.get_picture(image_id)
 
-        db.set(product_id, json.dumps(product))
-        db.set(image_id, image_url)
+def cache_products(db, changed_since=None):
+    """Cache products and their main images, one Moltin request per page."""
+    cached_list = db.get('products')
+    cached_products = json.loads(cached_list or '[]')
+    cached_idies = {product_id for product_id, product_name in cached_products}
+    products = []
+    values = {}
+    for product, image_id, image_url in moltin.iterate_products_with_images(
+        prefetch=True
+    ):
+        products.append(product)
+        product_id = product['id']
+        if (
+            changed_since is not None
+            and get_updated_at(product) <= changed_since
+            and product_id in cached_idies
+        ):
+            continue
+        values[product_id] = json.dumps(product)
+        if image_id is None:
+            continue
+        image_url = image_url or moltin.get_picture(image_id)
+        values[image_id] = image_url
+        values[f'image_{product_id}'] = image_url
+    products_data = [(product['id'], product['name']) for product in products]
+    if json.dumps(products_data) != cached_list:
+        values['products'] = json.dumps(products_data)
+    if values:
+        db.mset(values)
 
+    removed = cached_idies - {product['id'] for product in products}
+    removed_keys = {*removed, *(f'image_{product_id}' for product_id in removed)}
+    if removed_keys:
+        db.delete(*removed_keys)
+    invalidation.publish_invalidation(db, set(values) | removed_keys)
+    return get_watermark(products, changed_since or '')
 
-def cache_pizzerias(db):
+
+def cache_pizzerias(db, changed_since=None):
     pizzerias = moltin.get_all_entries(flow_slug='pizzerias')
+    watermark = get_watermark(pizzerias, changed_since or '')
+    if changed_since is not None and watermark == changed_since:
+        cached = json.loads(db.get('pizzerias') or '[]')
+        cached_idies = {pizzeria['id'] for pizzeria in cached}
+        if cached_idies == {pizzeria['id'] for pizzeria in pizzerias}:
+            return watermark
     db.set('pizzerias', json.dumps(pizzerias))
+    invalidation.publish_invalidation(db, {'pizzerias'})
+    return watermark
+
+
+def cache_vk_photos(db, vk):
+    for image_id, image_url in photos.iterate_cached_images(db):
+        try:
+            photos.get_photo_attachment(db, vk, image_id, image_url)
+        except (requests.RequestException, ApiError) as error:
+            logging.error(error)
+
+
+def sync_catalog(db, executor):
+    """Refresh only the catalog entries changed since the stored watermarks."""
+    watermarks = db.hgetall(WATERMARKS_KEY)
+    timings = {}
+    new_watermarks = {}
+    with timed('categories sync', timings):
+        new_watermarks['categories'] = cache_categories(
+            db, executor, watermarks.get('categories', '')
+        )
+    with timed('products sync', timings):
+        new_watermarks['products'] = cache_products(
+            db, watermarks.get('products', '')
+        )
+    with timed('pizzerias sync', timings):
+        new_watermarks['pizzerias'] = cache_pizzerias(
+            db, watermarks.get('pizzerias', '')
+        )
+    db.hmset(WATERMARKS_KEY, new_watermarks)
+    return timings
+
+
+def run_sync_daemon(db, interval, workers):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while True:
+            try:
+                sync_catalog(db, executor)
+            except (requests.RequestException, redis.RedisError) as error:
+                logging.error(error)
+            time.sleep(interval)
 
 
 def main():
-    db = redis.Redis(decode_responses=True)
-    cache_categories(db)
-    cache_products(db)
-    cache_pizzerias(db)
+    db = get_database()
+    workers = int(os.getenv('CACHE_WORKERS', DEFAULT_WORKERS))
+    timings = {}
+    watermarks = {}
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    with timed('total', timings), executor:
+        pizzerias = executor.submit(
+            run_timed, 'pizzerias', timings, cache_pizzerias, db
+        )
+        products = executor.submit(run_timed, 'products', timings, cache_products, db)
+        with timed('categories', timings):
+            watermarks['categories'] = cache_categories(db, executor)
+        watermarks['products'] = products.result()
+        watermarks['pizzerias'] = pizzerias.result()
+        db.hmset(WATERMARKS_KEY, watermarks)
+
+        vk_token = os.getenv('VK_TOKEN')
+        if vk_token:
+            vk = vk_api.VkApi(token=vk_token).get_api()
+            with timed('vk photos', timings):
+                cache_vk_photos(db, vk)
+
+        tg_token = os.getenv('TG_TOKEN')
+        tg_service_chat = os.getenv('TG_SERVICE_CHAT_ID')
+        if tg_token and tg_service_chat:
+            with timed('telegram photos', timings):
+                photos.cache_photo_file_ids(
+                    db, telegram.Bot(tg_token), tg_service_chat
+                )
+    return timings
 
 
 if __name__ == "__main__":
     load_dotenv()
-    main()
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Cache Moltin catalog in Redis')
+    parser.add_argument(
+        '--sync',
+        action='store_true',
+        help='keep the cache fresh, re-fetching only changed entries',
+    )
+    parser.add_argument(
+        '--interval',
+        type=int,
+        default=int(os.getenv('CACHE_SYNC_INTERVAL', DEFAULT_SYNC_INTERVAL)),
+        help='seconds between sync runs',
+    )
+    args = parser.parse_args()
+
+    if args.sync:
+        run_sync_daemon(
+            get_database(),
+            args.interval,
+            int(os.getenv('CACHE_WORKERS', DEFAULT_WORKERS)),
+        )
+    else:
+        main()
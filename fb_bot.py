@@ -1,4 +1,4 @@
-import json
+import hmac
 import logging
 import os
 from functools import wraps
@@ -6,11 +6,12 @@ from functools import wraps
 import requests
 from dotenv import load_dotenv
 from flask import Flask, request
-from yandex_geocoder import Client
-from yandex_geocoder.exceptions import YandexGeocoderAddressNotFound
 
-import moltin
+import invalidation
 import utils
+from cart_mirror import CartMirror
+from catalog import CatalogCache
+from sessions import UserSession
 
 app = Flask(__name__)
 FB_TOKEN = os.getenv('FB_PAGE_TOKEN')
@@ -48,9 +49,7 @@ def verify():
 def create_category_menu(categories):
     buttons = []
     for category in categories:
-        category_data = json.loads(db.get(category)) or moltin.get_category_by_slug(
-            category
-        )
+        category_data = catalog.get_category(category)
         name, slug = category_data['name'], category_data['slug']
         buttons.append({'type': 'postback', 'title': name, 'payload': slug})
     categories = {
@@ -63,9 +62,9 @@ def create_category_menu(categories):
 
 
 def create_all_menu(category_slug='main'):
-    categories = json.loads(
-        db.get('categories')) or moltin.get_all_categories()
-    categories.remove(category_slug)
+    categories = [
+        slug for slug in catalog.get_categories() if slug != category_slug
+    ]
 
     menu_elements = [
         {
@@ -76,17 +75,15 @@ def create_all_menu(category_slug='main'):
         }
     ]
 
-    category = json.loads(db.get(category_slug)) or moltin.get_category_by_slug(
-        category_slug
-    )
+    category = catalog.get_category(category_slug)
     category_products = category['products']
     for product in category_products:
-        pizza_data = json.loads(db.get(product)) or moltin.get_by_id(product)
+        pizza_data = catalog.get_product(product)
         pizza_name = pizza_data['name']
         pizza_desc = pizza_data['description']
         pizza_price = pizza_data['meta']['display_price']['with_tax']['formatted']
         image_id = pizza_data['relationships']['main_image']['data']['id']
-        image_url = db.get(image_id) or moltin.get_picture(image_id)
+        image_url = catalog.get_image_url(image_id)
         data = {
             'title': f'{pizza_name}, {pizza_price}',
             'subtitle': pizza_desc,
@@ -112,7 +109,7 @@ def send_message(headers, params, recipient_id, message):
 
 
 @headers_wrapper
-def send_main_menu(headers, params, recipient_id, message):
+def send_main_menu(headers, params, recipient_id, message, session):
     menu_elements = create_all_menu(category_slug='main')
 
     request_content = {
@@ -137,8 +134,8 @@ def send_main_menu(headers, params, recipient_id, message):
 
 @headers_wrapper
 def create_basket_menu(headers, params, recipient_id):
-    total = moltin.get_total(recipient_id)
-    user_cart = moltin.get_cart(recipient_id)
+    cart = carts.get(recipient_id)
+    total, user_cart = cart['total'], cart['items']
 
     menu_elements = [
         {
@@ -156,13 +153,12 @@ def create_basket_menu(headers, params, recipient_id):
     ]
     for product in user_cart:
         product_id = product['product_id']
-        pizza_data = json.loads(
-            db.get(product_id)) or moltin.get_by_id(product)
+        pizza_data = catalog.get_product(product_id)
         pizza_name = pizza_data['name']
         pizza_desc = pizza_data['description']
         pizza_price = pizza_data['meta']['display_price']['with_tax']['formatted']
         image_id = pizza_data['relationships']['main_image']['data']['id']
-        image_url = db.get(image_id) or moltin.get_picture(image_id)
+        image_url = catalog.get_image_url(image_id)
         data = {
             'title': f'{pizza_name}, {pizza_price}',
             'subtitle': pizza_desc,
@@ -202,7 +198,7 @@ def create_basket_menu(headers, params, recipient_id):
 
 @headers_wrapper
 def create_delivery_buttons(headers, params, recipient_id, distance):
-    if distance <= 20:
+    if utils.get_delivery_price(distance) is not None:
         menu_elements = [
             {
                 'title': 'Как получите заказ?',
@@ -242,10 +238,9 @@ def create_delivery_buttons(headers, params, recipient_id, distance):
 
 
 @headers_wrapper
-def handle_button(headers, params, recipient_id, message):
-    categories = json.loads(
-        db.get('categories')) or moltin.get_all_categories()
-    products = json.loads(db.get('products'))
+def handle_button(headers, params, recipient_id, message, session):
+    categories = catalog.get_categories()
+    products = dict(catalog.get_products())
 
     if message in categories:
         menu_elements = create_all_menu(category_slug=message)
@@ -274,13 +269,13 @@ def handle_button(headers, params, recipient_id, message):
     elif message == 'sale':
         pass
     elif message in products:
-        moltin.put_in_cart(recipient_id, message, 1)
+        carts.queue_put(recipient_id, message, 1)
         send_message(recipient_id, message='Добавили в корзину!')
         return 'HANDLE_MENU'
 
 
 @headers_wrapper
-def handle_basket(headers, params, recipient_id, message):
+def handle_basket(headers, params, recipient_id, message, session):
     if message == 'back_to_menu':
         menu_elements = create_all_menu()
         request_content = {
@@ -309,25 +304,25 @@ def handle_basket(headers, params, recipient_id, message):
         return 'HANDLE_ORDER'
     elif message.split()[0] == 'add':
         product_id = message.split()[1]
-        moltin.put_in_cart(recipient_id, product_id, 1)
+        carts.queue_put(recipient_id, product_id, 1)
         send_message(recipient_id, message='Добавили еще 1 пиццу.')
         create_basket_menu(recipient_id)
         return 'HANDLE_BASKET'
     elif message.split()[0] == 'remove':
         product_id = message.split()[1]
-        user_cart = moltin.get_cart(recipient_id)
+        user_cart = carts.get(recipient_id)['items']
         product_id_in_cart = next(product['cart_id'] for product in user_cart if product['product_id'] == product_id)
-        moltin.delete_item_in_cart(recipient_id, product_id_in_cart)
+        carts.delete(recipient_id, product_id_in_cart)
         send_message(recipient_id, message='Удалили из корзины.')
         create_basket_menu(recipient_id)
         return 'HANDLE_BASKET'
 
 
 @headers_wrapper
-def handle_order(headers, params, recipient_id, message):
+def handle_order(headers, params, recipient_id, message, session):
     try:
-        current_pos = Client.coordinates(message)
-    except YandexGeocoderAddressNotFound as error:
+        current_pos = utils.fetch_coordinates(message, db=db)
+    except IndexError as error:
         logging.error(error)
         send_message(
             recipient_id, message='Не смогли определить адрес, попробуйте еще.'
@@ -337,25 +332,22 @@ def handle_order(headers, params, recipient_id, message):
     if current_pos is None:
         return 'HANDLE_ORDER'
 
-    closest_pizzeria = utils.get_closest_pizzeria(db, current_pos)
+    closest_pizzeria = utils.get_closest_pizzeria(current_pos, db=db)
     text, distance = utils.calculate_distance_for_message(closest_pizzeria)
     send_message(recipient_id, message='Данные приняты, спасибо')
     send_message(recipient_id, message=text)
     create_delivery_buttons(recipient_id, distance=distance)
 
-    user = json.loads(db.get(f'facebook_{recipient_id}'))
-    user['closest_pizzeria'] = closest_pizzeria
-    user['user_address'] = message
-    db.set(f'facebook_{recipient_id}', json.dumps(user))
+    session['closest_pizzeria'] = closest_pizzeria
+    session['user_address'] = message
 
     return 'WAITING_CHOOSING'
 
 
 @headers_wrapper
-def handle_delivery_choosing(headers, params, recipient_id, message):
-    user = json.loads(db.get(f'facebook_{recipient_id}'))
-    closest_pizzeria = user['closest_pizzeria']['address']
-    user_address = user['user_address']
+def handle_delivery_choosing(headers, params, recipient_id, message, session):
+    closest_pizzeria = session['closest_pizzeria']['address']
+    user_address = session['user_address']
 
     if message == 'pickup':
         send_message(
@@ -379,13 +371,13 @@ def handle_users_reply(messaging_event):
     else:
         return
 
+    session = UserSession(db, f'facebook_{user_id}')
     if user_reply.lower().strip(' ') in ['start', 'старт']:
         user_state = 'START'
     else:
-        user = db.get(f'facebook_{user_id}')
         try:
-            user_state = json.loads(user)['state']
-        except TypeError as error:
+            user_state = session['state']
+        except KeyError as error:
             logging.exception(error)
             user_state = None
 
@@ -400,20 +392,33 @@ def handle_users_reply(messaging_event):
     state_handler = states_functions[user_state]
 
     try:
-        next_state = state_handler(user_id, user_reply)
+        next_state = state_handler(user_id, user_reply, session)
     except Exception as error:
         logging.exception(error)
         next_state = None
 
-    if next_state is None:
-        return None
-    user = db.get(f'facebook_{user_id}')
-    if user:
-        user_data = json.loads(user)
-        user_data['state'] = next_state
-    else:
-        user_data = {'state': next_state}
-    db.set(f'facebook_{user_id}', json.dumps(user_data))
+    if next_state is not None:
+        session.set_state(next_state)
+    session.save()
+
+
+@app.route('/moltin', methods=['POST'])
+def moltin_webhook():
+    """
+    Вебхук для интеграций Moltin: обновляет кеш каталога в Redis.
+    """
+    secret = os.getenv('MOLTIN_WEBHOOK_SECRET')
+    if not secret:
+        return 'Webhook secret is not configured', 503
+    received = request.headers.get('X-Moltin-Secret-Key', '')
+    if not hmac.compare_digest(received.encode(), secret.encode()):
+        return 'Secret key mismatch', 403
+    try:
+        invalidation.apply_moltin_event(db, request.get_json())
+    except Exception as error:
+        logging.exception(error)
+        return 'error', 500
+    return 'ok', 200
 
 
 @app.route('/', methods=['POST'])
@@ -435,7 +440,10 @@ def webhook():
 if __name__ == '__main__':
     load_dotenv()
 
-    global db
+    global db, catalog, carts
     db = utils.get_database()
+    catalog = CatalogCache(db)
+    carts = CartMirror(db)
+    catalog.start_listening()
 
     app.run(host='0.0.0.0', debug=True)
@@ -0,0 +1,181 @@
+import logging
+import os
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 3.05
+DEFAULT_READ_TIMEOUT = 10
+
+_client = None
+_client_lock = threading.Lock()
+_stats = defaultdict(lambda: {'requests': 0, 'errors': 0, 'time': 0.0})
+_stats_lock = threading.Lock()
+
+
+def get_pool_sizes():
+    """Parse HTTP_POOL_SIZES, e.g. `api.moltin.com=20,static-maps.yandex.ru=4`."""
+    pool_sizes = {}
+    for item in os.getenv('HTTP_POOL_SIZES', '').split(','):
+        if '=' not in item:
+            continue
+        host, size = item.split('=', 1)
+        pool_sizes[host.strip()] = int(size)
+    return pool_sizes
+
+
+def get_timeout():
+    return (
+        float(os.getenv('HTTP_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT)),
+        float(os.getenv('HTTP_READ_TIMEOUT', DEFAULT_READ_TIMEOUT)),
+    )
+
+
+def create_session():
+    pool_size = int(os.getenv('HTTP_POOL_SIZE', DEFAULT_POOL_SIZE))
+    session = requests.Session()
+    session.mount('https://', HTTPAdapter(pool_maxsize=pool_size))
+    session.mount('http://', HTTPAdapter(pool_maxsize=pool_size))
+    for host, size in get_pool_sizes().items():
+        session.mount(f'https://{host}/', HTTPAdapter(pool_maxsize=size))
+    return session
+
+
+def create_http2_client():
+    """httpx client with HTTP_POOL_SIZE connections, or HTTP_POOL_SIZES per host.
+
+    Every host listed in HTTP_POOL_SIZES gets its own transport, as httpx only
+    limits connections per client.
+    """
+    pool_size = int(os.getenv('HTTP_POOL_SIZE', DEFAULT_POOL_SIZE))
+    connect_timeout, read_timeout = get_timeout()
+    mounts = {
+        f'all://{host}': httpx.HTTPTransport(
+            http2=True, limits=httpx.Limits(max_connections=size)
+        )
+        for host, size in get_pool_sizes().items()
+    }
+    return httpx.Client(
+        http2=True,
+        limits=httpx.Limits(max_connections=pool_size),
+        timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+        mounts=mounts,
+    )
+
+
+def get_client():
+    global _client
+    if _client is not None:
+        return _client
+    with _client_lock:
+        if _client is None:
+            use_http2 = os.getenv('HTTP2_ENABLED', '').lower() in ('1', 'true', 'yes')
+            if use_http2 and httpx is None:
+                logging.warning('HTTP2_ENABLED is set, but httpx is not installed')
+            if use_http2 and httpx is not None:
+                _client = create_http2_client()
+            else:
+                _client = create_session()
+    return _client
+
+
+def close_client():
+    global _client
+    with _client_lock:
+        if _client is not None:
+            _client.close()
+            _client = None
+
+
+def request(method, url, **kwargs):
+    """Send a request through the shared pooled client and raise on HTTP errors.
+
+    httpx errors are re-raised as their `requests` counterparts, so callers
+    only have to handle `requests.RequestException`.
+    """
+    client = get_client()
+    host = urlsplit(url).hostname
+    started_at = time.monotonic()
+    try:
+        if isinstance(client, requests.Session):
+            kwargs.setdefault('timeout', get_timeout())
+            response = client.request(method, url, **kwargs)
+            response.raise_for_status()
+        else:
+            response = send_with_httpx(client, method, url, **kwargs)
+    except requests.RequestException:
+        record_request(host, started_at, failed=True)
+        raise
+    record_request(host, started_at)
+    return response
+
+
+def send_with_httpx(client, method, url, **kwargs):
+    if 'timeout' in kwargs:
+        connect_timeout, read_timeout = kwargs.pop('timeout')
+        kwargs['timeout'] = httpx.Timeout(read_timeout, connect=connect_timeout)
+    try:
+        response = client.request(method, url, **kwargs)
+        response.raise_for_status()
+    except httpx.HTTPStatusError as error:
+        raise requests.HTTPError(str(error), response=error.response) from error
+    except httpx.TimeoutException as error:
+        raise requests.Timeout(str(error)) from error
+    except httpx.TransportError as error:
+        raise requests.ConnectionError(str(error)) from error
+    return response
+
+
+def get(url, **kwargs):
+    return request('GET', url, **kwargs)
+
+
+def post(url, **kwargs):
+    return request('POST', url, **kwargs)
+
+
+def delete(url, **kwargs):
+    return request('DELETE', url, **kwargs)
+
+
+def record_request(host, started_at, failed=False):
+    with _stats_lock:
+        host_stats = _stats[host]
+        host_stats['requests'] += 1
+        host_stats['time'] += time.monotonic() - started_at
+        if failed:
+            host_stats['errors'] += 1
+
+
+def get_pool_stats():
+    """Return per-host request counters and, for `requests`, pool usage."""
+    with _stats_lock:
+        stats = {host: dict(host_stats) for host, host_stats in _stats.items()}
+
+    client = _client
+    if not isinstance(client, requests.Session):
+        return stats
+
+    for adapter in set(client.adapters.values()):
+        pools = adapter.poolmanager.pools
+        for pool_key in list(pools.keys()):
+            pool = pools.get(pool_key)
+            if pool is None:
+                continue
+            host_stats = stats.setdefault(
+                pool.host, {'requests': 0, 'errors': 0, 'time': 0.0}
+            )
+            host_stats['pool_size'] = pool.pool.maxsize if pool.pool else 0
+            host_stats['idle_connections'] = pool.pool.qsize() if pool.pool else 0
+            host_stats['opened_connections'] = pool.num_connections
+    return stats
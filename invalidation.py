@@ -0,0 +1,133 @@
+import json
+import logging
+import re
+
+import moltin
+
+INVALIDATION_CHANNEL = 'catalog_invalidation'
+CACHED_FLOWS = ('pizzerias',)
+ID_KEYED_RESOURCES = ('product', 'file')
+MOLTIN_ID_PATTERN = re.compile(r'^[0-9a-f]{8}(?:-[0-9a-f]{4}){3}-[0-9a-f]{12}$')
+
+
+def publish_invalidation(db, keys):
+    """Tell running bot processes that the cached `keys` have changed."""
+    if keys:
+        db.publish(INVALIDATION_CHANNEL, json.dumps(sorted(keys)))
+
+
+def get_event_resource(event):
+    resources = event.get('resources')
+    if isinstance(resources, str):
+        resources = json.loads(resources)
+    return (resources or {}).get('data', {})
+
+
+def cache_product(db, product_id):
+    product, image_id, image_url = moltin.get_product_with_image(product_id)
+    if image_id is None:
+        db.set(product_id, json.dumps(product))
+        db.delete(f'image_{product_id}')
+        return {product_id, f'image_{product_id}'}
+    db.mset(
+        {
+            product_id: json.dumps(product),
+            image_id: image_url,
+            f'image_{product_id}': image_url,
+        }
+    )
+    return {product_id, image_id, f'image_{product_id}'}
+
+
+def handle_product_event(db, action, resource):
+    product_id = resource['id']
+    db.set('products', json.dumps(moltin.get_products()))
+    if action == 'deleted':
+        db.delete(product_id, f'image_{product_id}')
+        return {'products', product_id, f'image_{product_id}'}
+    return {'products'} | cache_product(db, product_id)
+
+
+def handle_file_event(db, action, resource):
+    image_id = resource['id']
+    photo_keys = [f'vk_photo_{image_id}', *db.scan_iter(f'tg_photo_*_{image_id}')]
+    db.delete(image_id, *photo_keys)
+    changed_keys = {image_id, *photo_keys}
+
+    cached_products = json.loads(db.get('products') or '[]')
+    product_idies = [product_id for product_id, product_name in cached_products]
+    products = db.mget(product_idies) if product_idies else []
+    for product_id, product in zip(product_idies, products):
+        if product is None:
+            continue
+        if moltin.get_main_image_id(json.loads(product)) != image_id:
+            continue
+        if action == 'deleted':
+            db.delete(f'image_{product_id}')
+            changed_keys.add(f'image_{product_id}')
+        else:
+            changed_keys |= cache_product(db, product_id)
+    return changed_keys
+
+
+def handle_category_event(db, action, resource):
+    slug = resource.get('slug')
+    cached_slugs = json.loads(db.get('categories') or '[]')
+    categories = moltin.get_all_categories()
+    db.set('categories', json.dumps(categories))
+    changed_keys = {'categories'}
+
+    removed = set(cached_slugs) - set(categories)
+    if removed:
+        db.delete(*removed)
+        changed_keys |= removed
+    if action != 'deleted' and slug in categories:
+        db.set(slug, json.dumps(moltin.get_category_by_slug(slug)))
+        changed_keys.add(slug)
+    return changed_keys
+
+
+def get_entry_flow_slug(resource):
+    self_link = resource.get('links', {}).get('self', '')
+    match = re.search(r'flows/([^/]+)/entries', self_link)
+    return match.group(1) if match else 'pizzerias'
+
+
+def handle_entry_event(db, action, resource):
+    flow_slug = get_entry_flow_slug(resource)
+    if flow_slug not in CACHED_FLOWS:
+        return set()
+    db.set(flow_slug, json.dumps(moltin.get_all_entries(flow_slug)))
+    return {flow_slug}
+
+
+EVENT_HANDLERS = {
+    'product': handle_product_event,
+    'file': handle_file_event,
+    'category': handle_category_event,
+    'entry': handle_entry_event,
+    'flow-entry': handle_entry_event,
+}
+
+
+def apply_moltin_event(db, event):
+    """Update or evict the Redis keys touched by a Moltin webhook event.
+
+    Returns the set of changed keys, which is also published on
+    INVALIDATION_CHANNEL.
+    """
+    resource_type, _, action = event.get('triggered_by', '').partition('.')
+    event_handler = EVENT_HANDLERS.get(resource_type)
+    if event_handler is None:
+        logging.warning('Unsupported Moltin event: %s', event.get('triggered_by'))
+        return set()
+
+    resource = get_event_resource(event)
+    resource_id = resource.get('id', '')
+    if resource_type in ID_KEYED_RESOURCES and not MOLTIN_ID_PATTERN.match(resource_id):
+        logging.warning('Ignoring Moltin event for id %r', resource_id)
+        return set()
+
+    changed_keys = event_handler(db, action, resource)
+    publish_invalidation(db, changed_keys)
+    return changed_keys
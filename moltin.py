@@ -1,15 +1,29 @@
 import json
 import logging
 import os
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
 from functools import wraps
 from io import BytesIO
 
+import redis
 import requests
 
 from dotenv import load_dotenv
 from transliterate import translit
 
+import http_client
+
 MOLTIN_URL = 'https://api.moltin.com/v2/'
+MOLTIN_TOKEN_URL = 'https://api.moltin.com/oauth/access_token'
+
+TOKEN_KEY = 'moltin_token'
+TOKEN_LOCK_KEY = 'moltin_token_lock'
+TOKEN_EXPIRY_MARGIN = 60
+TOKEN_REFRESH_MARGIN = 300
+TOKEN_LOCK_TIMEOUT = 10
+DEFAULT_PAGE_LIMIT = 100
 
 
 def open_json(file):
@@ -18,20 +32,225 @@ def open_json(file):
     return data
 
 
+def get_token_storage():
+    return redis.Redis(
+        host=os.getenv('REDIS_URL', 'localhost'),
+        port=os.getenv('REDIS_PORT', 6379),
+        password=os.getenv('REDIS_PASSWORD'),
+        charset='utf-8',
+        decode_responses=True,
+    )
+
+
+def fetch_token():
+    data = {
+        'client_id': os.getenv('MOLTIN_CLIENT_ID'),
+        'client_secret': os.getenv('MOLTIN_CLIENT_SECRET'),
+        'grant_type': 'client_credentials',
+    }
+    response = http_client.get(MOLTIN_TOKEN_URL, data=data)
+    token_data = response.json()
+    return token_data['access_token'], token_data['expires']
+
+
+class TokenManager:
+    """Keeps one Moltin access token per process and shares it through Redis.
+
+    The token is used until TOKEN_EXPIRY_MARGIN seconds before its `expires`
+    time. Once it gets within TOKEN_REFRESH_MARGIN seconds of expiry, a single
+    background thread refreshes it, and a Redis lock makes sure only one of
+    the bot processes actually asks Moltin for a new token.
+    """
+
+    def __init__(self, storage_factory=get_token_storage):
+        self._storage_factory = storage_factory
+        self._storage = None
+        self._token = None
+        self._expires = 0
+        self._lock = threading.Lock()
+        self._refreshing_lock = threading.Lock()
+        self._refreshing = False
+
+    @property
+    def storage(self):
+        if self._storage is None:
+            self._storage = self._storage_factory()
+        return self._storage
+
+    def get_cached_token(self):
+        """Return the token without blocking, or None if it has to be fetched."""
+        now = time.time()
+        if not self._is_usable(self._expires, now):
+            return None
+        if now >= self._expires - TOKEN_REFRESH_MARGIN:
+            self._refresh_in_background()
+        return self._token
+
+    def get_token(self):
+        token = self.get_cached_token()
+        if token is not None:
+            return token
+
+        with self._lock:
+            if not self._is_usable(self._expires, time.time()):
+                self._refresh()
+            return self._token
+
+    def invalidate(self, token):
+        """Forget `token` after Moltin rejected it, here and in Redis."""
+        with self._lock:
+            if self._token == token:
+                self._token, self._expires = None, 0
+            shared = self._read_shared()
+            if shared and shared[0] == token:
+                try:
+                    self.storage.delete(TOKEN_KEY)
+                except redis.RedisError as error:
+                    logging.warning(error)
+
+    def _is_usable(self, expires, now):
+        return self._token is not None and now < expires - TOKEN_EXPIRY_MARGIN
+
+    def _refresh_in_background(self):
+        with self._refreshing_lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target=self._background_refresh, daemon=True).start()
+
+    def _background_refresh(self):
+        try:
+            with self._lock:
+                self._refresh()
+        except (requests.RequestException, KeyError) as error:
+            logging.error(error)
+        finally:
+            self._refreshing = False
+
+    def _refresh(self):
+        shared = self._read_shared()
+        if shared and shared[1] - TOKEN_REFRESH_MARGIN > time.time():
+            self._token, self._expires = shared
+            return
+
+        locked = self._acquire_refresh_lock()
+        if not locked:
+            shared = self._wait_for_shared(previous=shared)
+            if shared and shared[1] - TOKEN_EXPIRY_MARGIN > time.time():
+                self._token, self._expires = shared
+                return
+
+        try:
+            self._token, self._expires = fetch_token()
+            self._write_shared(self._token, self._expires)
+        finally:
+            if locked:
+                self._release_refresh_lock()
+
+    def _read_shared(self):
+        try:
+            token_data = self.storage.get(TOKEN_KEY)
+        except redis.RedisError as error:
+            logging.warning(error)
+            return None
+        if token_data is None:
+            return None
+        token_data = json.loads(token_data)
+        return token_data['access_token'], token_data['expires']
+
+    def _write_shared(self, token, expires):
+        ttl = int(expires - time.time() - TOKEN_EXPIRY_MARGIN)
+        if ttl <= 0:
+            return
+        token_data = json.dumps({'access_token': token, 'expires': expires})
+        try:
+            self.storage.set(TOKEN_KEY, token_data, ex=ttl)
+        except redis.RedisError as error:
+            logging.warning(error)
+
+    def _acquire_refresh_lock(self):
+        try:
+            locked = self.storage.set(
+                TOKEN_LOCK_KEY, os.getpid(), nx=True, ex=TOKEN_LOCK_TIMEOUT
+            )
+        except redis.RedisError as error:
+            logging.warning(error)
+            return True
+        return bool(locked)
+
+    def _release_refresh_lock(self):
+        try:
+            self.storage.delete(TOKEN_LOCK_KEY)
+        except redis.RedisError as error:
+            logging.warning(error)
+
+    def _wait_for_shared(self, previous):
+        deadline = time.time() + TOKEN_LOCK_TIMEOUT
+        while time.time() < deadline:
+            time.sleep(0.1)
+            shared = self._read_shared()
+            if shared and shared != previous:
+                return shared
+        return previous
+
+
+token_manager = TokenManager()
+
+
 def headers_wrapper(func):
     @wraps(func)
     def inner(*args, **kwargs):
-        url = 'https://api.moltin.com/oauth/access_token'
-        data = {
-            'client_id': os.getenv('MOLTIN_CLIENT_ID'),
-            'client_secret': os.getenv('MOLTIN_CLIENT_SECRET'),
-            'grant_type': 'client_credentials',
-        }
-        response = requests.get(url, data=data)
-        response.raise_for_status()
-        token = response.json().get('access_token')
-        headers = {'Authorization': f'Bearer {token}'}
-        return func(headers, *args, **kwargs)
+        token = token_manager.get_token()
+        try:
+            return func({'Authorization': f'Bearer {token}'}, *args, **kwargs)
+        except requests.HTTPError as error:
+            if error.response is None or error.response.status_code != 401:
+                raise
+        token_manager.invalidate(token)
+        token = token_manager.get_token()
+        return func({'Authorization': f'Bearer {token}'}, *args, **kwargs)
+
+    return inner
+
+
+class SingleFlight:
+    """Shares one call among the threads that ask for the same key at once.
+
+    The first caller runs the function, the others wait for its result or
+    exception. Results are shared, so callers must not mutate them.
+    """
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def do(self, key, func, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = Future()
+        if not is_leader:
+            return call.result()
+
+        try:
+            call.set_result(func(*args, **kwargs))
+        except Exception as error:
+            call.set_exception(error)
+        finally:
+            with self._lock:
+                del self._calls[key]
+        return call.result()
+
+
+read_flights = SingleFlight()
+
+
+def single_flight(func):
+    @wraps(func)
+    def inner(*args, **kwargs):
+        key = (func.__name__, args, tuple(sorted(kwargs.items())))
+        return read_flights.do(key, func, *args, **kwargs)
 
     return inner
 
@@ -55,8 +274,7 @@ def create_product(headers, name, description, price):
             'commodity_type': 'physical',
         }
     }
-    response = requests.post(url=url, headers=headers, json=data)
-    response.raise_for_status()
+    response = http_client.post(url=url, headers=headers, json=data)
     return response.json()['data']['id']
 
 
@@ -64,11 +282,10 @@ def create_product(headers, name, description, price):
 def load_image(headers, image_url):
     url = f'{MOLTIN_URL}files'
     image_name = image_url.split('/')[-1]
-    image_content = BytesIO(requests.get(image_url).content)
+    image_content = BytesIO(http_client.get(image_url).content)
     files = {'file': (image_name, image_content)}
-    response = requests.post(url=url, headers=headers, files=files)
+    response = http_client.post(url=url, headers=headers, files=files)
     image_content.close()
-    response.raise_for_status()
     return response.json()['data']['id']
 
 
@@ -76,8 +293,7 @@ def load_image(headers, image_url):
 def attach_image(headers, product_id, image_id):
     url = f'{MOLTIN_URL}products/{product_id}/relationships/main-image'
     data = {'data': {'type': 'main_image', 'id': image_id}}
-    response = requests.post(url=url, headers=headers, json=data)
-    response.raise_for_status()
+    http_client.post(url=url, headers=headers, json=data)
 
 
 def create_full_product(name, description, price, image):
@@ -121,8 +337,7 @@ def create_flow(headers, name, slug, description):
             'name': name,
         }
     }
-    response = requests.post(url=url, headers=headers, json=data)
-    response.raise_for_status()
+    response = http_client.post(url=url, headers=headers, json=data)
     return response.json()['data']['id'], response.json()['data']['slug']
 
 
@@ -144,8 +359,7 @@ def create_flow_fields(headers, flow_id, fields_dict):
             }
         }
         try:
-            response = requests.post(url=url, headers=headers, json=data)
-            response.raise_for_status()
+            http_client.post(url=url, headers=headers, json=data)
         except requests.HTTPError as error:
             logging.error(error)
 
@@ -166,8 +380,7 @@ def create_pizzeria_entry(
         }
     }
 
-    response = requests.post(url=url, headers=headers, json=data)
-    response.raise_for_status()
+    http_client.post(url=url, headers=headers, json=data)
 
 
 @headers_wrapper
@@ -184,8 +397,7 @@ def create_customer_entry(
             'latitude': latitude,
         }
     }
-    response = requests.post(url=url, headers=headers, json=data)
-    response.raise_for_status()
+    response = http_client.post(url=url, headers=headers, json=data)
     return response.json()['data']['id']
 
 
@@ -213,48 +425,126 @@ def create_pizzaries_from_json(file):
 
 
 @headers_wrapper
-def get_products(headers):
+def fetch_page(headers, url, params=None):
+    response = http_client.get(url=url, headers=headers, params=params)
+    return response.json()
+
+
+def get_next_page_url(page):
+    if not page.get('data'):
+        return None
+    return (page.get('links') or {}).get('next')
+
+
+def iterate_page_responses(
+    url, params=None, page_limit=DEFAULT_PAGE_LIMIT, prefetch=False
+):
+    """Yield every page of a Moltin list endpoint, following `links.next`.
+
+    With `prefetch=True` the next page is requested in a background thread
+    while the current one is being consumed.
+    """
+    params = {**(params or {}), 'page[limit]': page_limit, 'page[offset]': 0}
+    if not prefetch:
+        while url:
+            page = fetch_page(url, params)
+            yield page
+            url, params = get_next_page_url(page), None
+        return
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        next_page = executor.submit(fetch_page, url, params)
+        while next_page is not None:
+            page = next_page.result()
+            next_url = get_next_page_url(page)
+            next_page = executor.submit(fetch_page, next_url) if next_url else None
+            yield page
+
+
+def iterate_pages(url, params=None, page_limit=DEFAULT_PAGE_LIMIT, prefetch=False):
+    for page in iterate_page_responses(url, params, page_limit, prefetch):
+        yield from page['data']
+
+
+def iterate_products(page_limit=DEFAULT_PAGE_LIMIT, prefetch=False):
+    url = f'{MOLTIN_URL}products'
+    return iterate_pages(url, page_limit=page_limit, prefetch=prefetch)
+
+
+def get_main_image_id(product):
+    main_image = product.get('relationships', {}).get('main_image', {})
+    return (main_image.get('data') or {}).get('id')
+
+
+def get_included_image_urls(page):
+    main_images = page.get('included', {}).get('main_images', [])
+    return {image['id']: image['link']['href'] for image in main_images}
+
+
+def iterate_products_with_images(page_limit=DEFAULT_PAGE_LIMIT, prefetch=False):
+    """Yield `(product, image_id, image_url)` using one request per page."""
     url = f'{MOLTIN_URL}products'
-    response = requests.get(url=url, headers=headers)
-    response.raise_for_status()
-    products = response.json()['data']
+    params = {'include': 'main_image'}
+    for page in iterate_page_responses(url, params, page_limit, prefetch):
+        image_urls = get_included_image_urls(page)
+        for product in page['data']:
+            image_id = get_main_image_id(product)
+            yield product, image_id, image_urls.get(image_id)
+
+
+def iterate_entries(flow_slug, page_limit=DEFAULT_PAGE_LIMIT, prefetch=False):
+    url = f'{MOLTIN_URL}flows/{flow_slug}/entries'
+    return iterate_pages(url, page_limit=page_limit, prefetch=prefetch)
+
+
+def iterate_categories(page_limit=DEFAULT_PAGE_LIMIT, prefetch=False):
+    url = f'{MOLTIN_URL}categories'
+    return iterate_pages(url, page_limit=page_limit, prefetch=prefetch)
+
+
+def get_products_data():
+    return list(iterate_products(prefetch=True))
+
+
+def get_products():
+    products = get_products_data()
     return [(product['id'], product['name']) for product in products]
 
 
+@single_flight
 @headers_wrapper
 def get_by_id(headers, product_id):
     url = f'{MOLTIN_URL}products/{product_id}'
 
-    response = requests.get(url=url, headers=headers)
-    response.raise_for_status()
+    response = http_client.get(url=url, headers=headers)
     return response.json()['data']
 
 
+@single_flight
 @headers_wrapper
-def get_picture(headers, product_id):
-    url = f'{MOLTIN_URL}files/{product_id}'
+def get_product_with_image(headers, product_id):
+    """Return `(product, image_id, image_url)` in a single request."""
+    url = f'{MOLTIN_URL}products/{product_id}'
+    params = {'include': 'main_image'}
 
-    response = requests.get(url=url, headers=headers)
-    response.raise_for_status()
-    return response.json()['data']['link']['href']
+    response = http_client.get(url=url, headers=headers, params=params).json()
+    image_id = get_main_image_id(response['data'])
+    image_url = get_included_image_urls(response).get(image_id)
+    return response['data'], image_id, image_url
 
 
+@single_flight
 @headers_wrapper
-def put_in_cart(headers, reference, product_id, quantity):
-    url = f'{MOLTIN_URL}carts/{reference}/items'
-    data = {'data': {'id': product_id, 'type': 'cart_item', 'quantity': quantity}}
-    response = requests.post(url=url, headers=headers, json=data)
-    response.raise_for_status()
+def get_picture(headers, product_id):
+    url = f'{MOLTIN_URL}files/{product_id}'
 
+    response = http_client.get(url=url, headers=headers)
+    return response.json()['data']['link']['href']
 
-@headers_wrapper
-def get_cart(headers, reference):
-    url = f'{MOLTIN_URL}carts/{reference}/items'
-    response = requests.get(url=url, headers=headers)
-    response.raise_for_status()
 
+def parse_cart_items(items):
     user_cart = []
-    for product in response.json()['data']:
+    for product in items:
         user_cart.append(
             {
                 'cart_id': product['id'],
@@ -272,18 +562,51 @@ def get_cart(headers, reference):
     return user_cart
 
 
+def parse_cart(response):
+    """Turn a Moltin cart items response into `{'items': [...], 'total': ...}`.
+
+    `total` is None when Moltin did not send the cart totals along.
+    """
+    display_price = response.get('meta', {}).get('display_price', {})
+    total = display_price.get('with_tax', {}).get('formatted')
+    return {'items': parse_cart_items(response['data']), 'total': total}
+
+
+@headers_wrapper
+def put_in_cart(headers, reference, product_id, quantity):
+    url = f'{MOLTIN_URL}carts/{reference}/items'
+    data = {'data': {'id': product_id, 'type': 'cart_item', 'quantity': quantity}}
+    response = http_client.post(url=url, headers=headers, json=data)
+    return parse_cart(response.json())
+
+
+@headers_wrapper
+def get_cart(headers, reference):
+    url = f'{MOLTIN_URL}carts/{reference}/items'
+    response = http_client.get(url=url, headers=headers)
+    return parse_cart_items(response.json()['data'])
+
+
+@headers_wrapper
+def get_cart_with_total(headers, reference):
+    url = f'{MOLTIN_URL}carts/{reference}/items'
+    response = http_client.get(url=url, headers=headers)
+    return parse_cart(response.json())
+
+
 @headers_wrapper
 def get_total(headers, reference):
     url = f'{MOLTIN_URL}carts/{reference}'
 
-    response = requests.get(url=url, headers=headers)
-    response.raise_for_status()
+    response = http_client.get(url=url, headers=headers)
     return response.json()['data']['meta']['display_price']['with_tax']['formatted']
 
 
 def format_basket_for_sending(user_id):
-    user_basket = get_cart(user_id)
-    user_total = get_total(user_id)
+    return format_basket(get_cart(user_id), get_total(user_id))
+
+
+def format_basket(user_basket, user_total):
     message = []
     for product in user_basket:
         name = product['name']
@@ -298,8 +621,8 @@ def format_basket_for_sending(user_id):
 @headers_wrapper
 def delete_item_in_cart(headers, reference, product_id):
     url = f'{MOLTIN_URL}carts/{reference}/items/{product_id}'
-    response = requests.delete(url, headers=headers)
-    response.raise_for_status()
+    response = http_client.delete(url, headers=headers)
+    return parse_cart(response.json())
 
 
 @headers_wrapper
@@ -313,51 +636,47 @@ def create_customer(headers, user_id, user_email, user_name, user_surname=None):
         }
     }
 
-    response = requests.post(url, headers=headers, json=data)
-    response.raise_for_status()
+    http_client.post(url, headers=headers, json=data)
 
 
 def check_product_in_cart(reference, product_id):
-    carts = get_cart(reference)
+    return format_in_cart_badge(get_cart(reference), product_id)
+
+
+def format_in_cart_badge(carts, product_id):
     for item in carts:
         if item['product_id'] == product_id:
             quantity, total = item['quantity'], item['total']
             return f'*Уже в корзине:* {quantity} шт., всего на сумму {total}'
 
 
-@headers_wrapper
-def get_all_entries(headers, flow_slug):
-    url = f'{MOLTIN_URL}flows/{flow_slug}/entries'
-    response = requests.get(url=url, headers=headers)
-    response.raise_for_status()
-    return response.json()['data']
+def get_all_entries(flow_slug):
+    return list(iterate_entries(flow_slug, prefetch=True))
 
 
 @headers_wrapper
 def get_deliverer(headers, entry_id, flow_slug='pizzerias'):
     url = f'{MOLTIN_URL}flows/{flow_slug}/entries/{entry_id}'
-    response = requests.get(url=url, headers=headers)
-    response.raise_for_status()
+    response = http_client.get(url=url, headers=headers)
     return response.json()['data']['deliverer']
 
 
 @headers_wrapper
 def get_customer_coordinates(headers, entry_id, flow_slug='adress'):
     url = f'{MOLTIN_URL}flows/{flow_slug}/entries/{entry_id}'
-    response = requests.get(url=url, headers=headers)
-    response.raise_for_status()
+    response = http_client.get(url=url, headers=headers)
     return (
         float(response.json()['data']['longitude']),
         float(response.json()['data']['latitude']),
     )
 
 
+@single_flight
 @headers_wrapper
 def get_category_by_slug(headers, category_slug):
     url = f'{MOLTIN_URL}categories'
     params = {'filter': f'eq(slug,{category_slug})'}
-    response = requests.get(url=url, headers=headers, params=params)
-    response.raise_for_status()
+    response = http_client.get(url=url, headers=headers, params=params)
     products = response.json()['data'][0]['relationships']['products']['data']
     return {
         'name': response.json()['data'][0]['name'],
@@ -366,11 +685,12 @@ def get_category_by_slug(headers, category_slug):
     }
 
 
-@headers_wrapper
-def get_all_categories(headers):
-    url = f'{MOLTIN_URL}categories'
-    response = requests.get(url=url, headers=headers)
-    categories = response.json()['data']
+def get_categories_data():
+    return list(iterate_categories(prefetch=True))
+
+
+def get_all_categories():
+    categories = get_categories_data()
     return [category['slug'] for category in categories]
 
 
@@ -0,0 +1,62 @@
+import json
+import logging
+from io import BytesIO
+
+from telegram.error import TelegramError
+from vk_api import VkUpload
+
+import http_client
+import moltin
+import utils
+
+
+def upload_photo_content(vk, content):
+    upload = VkUpload(vk)
+
+    attachment = []
+    file_obj = BytesIO(content)
+    photo = upload.photo_messages(file_obj)[0]
+    attachment.append('photo{}_{}'.format(photo['owner_id'], photo['id']))
+    return attachment
+
+
+def upload_photo_for_message(vk, image_url):
+    image_content = http_client.get(image_url)
+    return upload_photo_content(vk, image_content.content)
+
+
+def get_photo_attachment(db, vk, image_id, image_url=None):
+    key = f'vk_photo_{image_id}'
+    attachment = db.get(key)
+    if attachment is None:
+        image_url = image_url or db.get(image_id) or moltin.get_picture(image_id)
+        attachment = upload_photo_for_message(vk, image_url)[0]
+        db.set(key, attachment)
+    return [attachment]
+
+
+def iterate_cached_images(db):
+    """Yield (image_id, image_url) of the cached products that have a picture."""
+    products = json.loads(db.get('products') or '[]')
+    for product_id, product_name in products:
+        product = db.get(product_id)
+        image_id = moltin.get_main_image_id(json.loads(product)) if product else None
+        image_url = db.get(image_id) if image_id else None
+        if image_url is not None:
+            yield image_id, image_url
+
+
+def cache_photo_file_ids(db, bot, chat_id):
+    """Upload product photos to `chat_id` once and keep their Telegram file ids."""
+    for image_id, image_url in iterate_cached_images(db):
+        photo_key = utils.get_telegram_photo_key(bot.token, image_id)
+        if db.get(photo_key) is not None:
+            continue
+        try:
+            message = bot.send_photo(
+                chat_id=chat_id, photo=image_url, disable_notification=True
+            )
+        except TelegramError as error:
+            logging.error('%s: %s', image_id, error)
+            continue
+        db.set(photo_key, message.photo[-1].file_id)
@@ -0,0 +1,318 @@
+import argparse
+import json
+import logging
+import os
+import re
+import time
+from collections import defaultdict
+
+import redis
+from dotenv import load_dotenv
+
+from utils import get_database
+
+USER_KEY_PATTERN = re.compile(r'^(-?\d+|vk_\d+|facebook_\d+)$')
+PLATFORM_PATTERNS = (
+    ('telegram', re.compile(r'^-?\d+$')),
+    ('vk', re.compile(r'^vk_\d+$')),
+    ('facebook', re.compile(r'^facebook_\d+$')),
+)
+KEY_PREFIX_PATTERN = re.compile(r'^([a-z]+(?:_[a-z]+)*)[_:]')
+
+DEFAULT_SESSION_TTL = 30 * 24 * 60 * 60
+DEFAULT_CHECKOUT_TTL = 24 * 60 * 60
+CHECKOUT_FIELDS = ('closest_pizzeria', 'customer_geo', 'user_address')
+CHECKOUT_EXPIRES_FIELD = 'checkout_expires_at'
+
+SAVE_SCRIPT = """
+if ARGV[1] == '1' and (redis.call('HGET', KEYS[1], 'state') or '') ~= ARGV[2] then
+    return 0
+end
+if ARGV[4] == '1' then
+    redis.call('DEL', KEYS[1])
+end
+local deleted = tonumber(ARGV[6])
+local changed = tonumber(ARGV[7])
+local increments = tonumber(ARGV[8])
+local index = 8
+for _ = 1, deleted do
+    redis.call('HDEL', KEYS[1], ARGV[index + 1])
+    index = index + 1
+end
+for _ = 1, changed do
+    redis.call('HSET', KEYS[1], ARGV[index + 1], ARGV[index + 2])
+    index = index + 2
+end
+for _ = 1, increments do
+    redis.call('HINCRBY', KEYS[1], ARGV[index + 1], ARGV[index + 2])
+    index = index + 2
+end
+if ARGV[1] == '1' then
+    redis.call('HSET', KEYS[1], 'state', ARGV[3])
+end
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+return 1
+"""
+
+COMPACT_SCRIPT = """
+local stripped = 0
+local expires = tonumber(redis.call('HGET', KEYS[1], ARGV[3]))
+if expires and expires < tonumber(ARGV[1]) then
+    redis.call('HDEL', KEYS[1], unpack(ARGV, 3))
+    stripped = 1
+end
+if redis.call('TTL', KEYS[1]) == -1 then
+    redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return stripped
+"""
+
+
+def get_session_ttl():
+    return int(os.getenv('SESSION_TTL', DEFAULT_SESSION_TTL))
+
+
+def get_checkout_ttl():
+    return int(os.getenv('CHECKOUT_TTL', DEFAULT_CHECKOUT_TTL))
+
+
+def encode_fields(fields):
+    return {field: json.dumps(value) for field, value in fields.items()}
+
+
+def decode_fields(fields):
+    return {field: json.loads(value) for field, value in fields.items()}
+
+
+def convert_blob(pipe, key):
+    """Replace a JSON string user record with a hash, inside a WATCH block."""
+    if pipe.type(key) != 'string':
+        return False
+    try:
+        user = json.loads(pipe.get(key))
+    except ValueError:
+        return False
+    if not isinstance(user, dict):
+        return False
+
+    pipe.multi()
+    pipe.delete(key)
+    if user:
+        pipe.hmset(key, encode_fields(user))
+    return True
+
+
+def migrate_blob(db, key):
+    return db.transaction(
+        lambda pipe: convert_blob(pipe, key), key, value_from_callable=True
+    )
+
+
+def migrate_blobs(db):
+    migrated = 0
+    for key in db.scan_iter(count=1000):
+        if USER_KEY_PATTERN.match(key) and migrate_blob(db, key):
+            migrated += 1
+    return migrated
+
+
+def compact_sessions(db):
+    """Strip expired checkout fields and give TTL-less user keys a TTL."""
+    stats = {'keys': 0, 'stripped': 0}
+    compact = db.register_script(COMPACT_SCRIPT)
+    args = [time.time(), get_session_ttl(), CHECKOUT_EXPIRES_FIELD, *CHECKOUT_FIELDS]
+    for key in db.scan_iter(count=1000):
+        if not USER_KEY_PATTERN.match(key):
+            continue
+        try:
+            stats['stripped'] += compact(keys=[key], args=args)
+        except redis.ResponseError as error:
+            logging.warning('%s: %s', key, error)
+            continue
+        stats['keys'] += 1
+    return stats
+
+
+def get_key_group(key):
+    for platform, pattern in PLATFORM_PATTERNS:
+        if pattern.match(key):
+            return platform
+    match = KEY_PREFIX_PATTERN.match(key)
+    return match.group(1) if match else 'other'
+
+
+def get_memory_report(db, batch_size=500):
+    """Count keys and their MEMORY USAGE bytes per platform or key prefix."""
+    report = defaultdict(lambda: {'keys': 0, 'bytes': 0})
+    keys = []
+    for key in db.scan_iter(count=batch_size):
+        keys.append(key)
+        if len(keys) == batch_size:
+            add_memory_usage(db, keys, report)
+            keys = []
+    add_memory_usage(db, keys, report)
+    return dict(report)
+
+
+def add_memory_usage(db, keys, report):
+    pipe = db.pipeline(transaction=False)
+    for key in keys:
+        pipe.memory_usage(key)
+    for key, usage in zip(keys, pipe.execute()):
+        group = report[get_key_group(key)]
+        group['keys'] += 1
+        group['bytes'] += usage or 0
+
+
+def print_memory_report(report):
+    print(f'{"group":<20}{"keys":>10}{"bytes":>14}')
+    for group, usage in sorted(report.items(), key=lambda item: -item[1]['bytes']):
+        print(f'{group:<20}{usage["keys"]:>10}{usage["bytes"]:>14}')
+
+
+class UserSession:
+    """User record of a sync bot, stored as a Redis hash of JSON fields.
+
+    The hash is fetched with one HGETALL on first access. save() sends the
+    changed fields, counter increments and the state transition to
+    SAVE_SCRIPT in one round trip. When the update moves the state, the
+    script applies nothing unless the state is still the one that was read.
+
+    Every save pushes the key's expiry SESSION_TTL seconds ahead. Checkout
+    fields live for CHECKOUT_TTL seconds after they were last written.
+    """
+
+    def __init__(self, db, key):
+        self.db = db
+        self.key = key
+        self._data = None
+        self._dirty = set()
+        self._increments = {}
+        self._deleted = set()
+        self._reset = False
+        self._seen_state = ''
+        self._next_state = None
+
+    @property
+    def data(self):
+        if self._data is None:
+            try:
+                user = self.db.hgetall(self.key)
+            except redis.ResponseError:
+                migrate_blob(self.db, self.key)
+                user = self.db.hgetall(self.key)
+            self._seen_state = user.get('state', '')
+            self._data = decode_fields(user)
+            self._drop_expired_checkout()
+        return self._data
+
+    def _drop_expired_checkout(self):
+        expires_at = self._data.get(CHECKOUT_EXPIRES_FIELD)
+        if expires_at is None or expires_at >= time.time():
+            return
+        for field in (CHECKOUT_EXPIRES_FIELD, *CHECKOUT_FIELDS):
+            if self._data.pop(field, None) is not None:
+                self._deleted.add(field)
+
+    def __getitem__(self, field):
+        return self.data[field]
+
+    def __setitem__(self, field, value):
+        self.data[field] = value
+        self._dirty.add(field)
+        self._deleted.discard(field)
+        self._increments.pop(field, None)
+        if field in CHECKOUT_FIELDS:
+            self[CHECKOUT_EXPIRES_FIELD] = time.time() + get_checkout_ttl()
+
+    def get(self, field, default=None):
+        return self.data.get(field, default)
+
+    def incr(self, field, amount=1):
+        self.data[field] += amount
+        if field not in self._dirty:
+            self._increments[field] = self._increments.get(field, 0) + amount
+
+    def set_state(self, state):
+        if self._reset:
+            self['state'] = state
+            return
+        self.data['state'] = state
+        self._next_state = state
+
+    def reset(self, **fields):
+        """Start a new record with `fields` without reading the stored one."""
+        self._data = dict(fields)
+        self._dirty = set(fields)
+        self._increments = {}
+        self._deleted = set()
+        self._reset = True
+        self._next_state = None
+
+    def save(self):
+        changed = encode_fields({field: self._data[field] for field in self._dirty})
+        moves_state = self._next_state is not None
+        args = [
+            int(moves_state),
+            self._seen_state,
+            json.dumps(self._next_state),
+            int(self._reset),
+            get_session_ttl(),
+            len(self._deleted),
+            len(changed),
+            len(self._increments),
+            *self._deleted,
+        ]
+        for fields in (changed, self._increments):
+            for field, value in fields.items():
+                args.extend((field, value))
+        save = self.db.register_script(SAVE_SCRIPT)
+
+        if not save(keys=[self.key], args=args):
+            logging.warning(
+                'State of %s was changed by another update, dropped %s',
+                self.key,
+                sorted({*self._deleted, *changed, *self._increments}),
+            )
+        self._dirty.clear()
+        self._increments.clear()
+        self._deleted.clear()
+        self._reset = False
+        self._next_state = None
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Manage bot user sessions in Redis')
+    parser.add_argument(
+        'command',
+        choices=['migrate', 'compact', 'report'],
+        help=(
+            'migrate: convert JSON string user records into hashes; '
+            'compact: strip expired checkout fields and set missing TTLs; '
+            'report: show key count and memory usage per platform and prefix'
+        ),
+    )
+    parser.add_argument(
+        '--interval',
+        type=int,
+        help='keep compacting, sleeping this many seconds between runs',
+    )
+    args = parser.parse_args()
+    db = get_database()
+
+    if args.command == 'migrate':
+        logging.info('Migrated %s user records', migrate_blobs(db))
+    elif args.command == 'report':
+        print_memory_report(get_memory_report(db))
+    elif args.interval is None:
+        logging.info('Compacted sessions: %s', compact_sessions(db))
+    else:
+        while True:
+            try:
+                logging.info('Compacted sessions: %s', compact_sessions(db))
+            except redis.RedisError as error:
+                logging.error(error)
+            time.sleep(args.interval)
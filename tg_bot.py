@@ -1,8 +1,6 @@
-import json
 import logging
 import os
 
-import redis
 from dotenv import load_dotenv
 from telegram import (
     InlineKeyboardButton,
@@ -13,6 +11,7 @@ from telegram import (
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove,
 )
+from telegram.error import BadRequest
 from telegram.ext import (
     CallbackQueryHandler,
     CommandHandler,
@@ -24,30 +23,14 @@ from telegram.ext import (
 
 import moltin
 import utils
-
-
-def get_database():
-    db_url = os.getenv('REDIS_URL')
-    db_port = os.getenv('REDIS_PORT')
-    db_password = os.getenv('REDIS_PASSWORD')
-    database = redis.Redis(
-        host=db_url,
-        port=db_port,
-        password=db_password,
-        charset='utf-8',
-        decode_responses=True,
-    )
-    return database
-
-
-def create_chunks(products, size=7):
-    for i in range(0, len(products), size):
-        yield products[i: i + size]
+from cart_mirror import CartMirror
+from catalog import CatalogCache
+from sessions import UserSession
 
 
 def send_order_to_deliverer(context, order_id, deliverer, longitude, latitude):
     order_text = 'Офомлен заказ на:\n\n'
-    order_text += moltin.format_basket_for_sending(order_id)
+    order_text += carts.format_basket(order_id)
     order_text += '\n\nКоординаты клиента:'
     context.bot.send_message(
         chat_id=deliverer, text=order_text, parse_mode=ParseMode.MARKDOWN
@@ -55,14 +38,38 @@ def send_order_to_deliverer(context, order_id, deliverer, longitude, latitude):
     context.bot.send_location(chat_id=deliverer, longitude=longitude, latitude=latitude)
 
 
-def create_menu_buttons(chunk):
-    products = moltin.get_products()
-    chunks = list(create_chunks(products))
-    last_chunk = len(chunks) - 1
+def send_product_photo(context, chat_id, image_id, caption, reply_markup):
+    photo_key = utils.get_telegram_photo_key(context.bot.token, image_id)
+    file_id = db.get(photo_key)
+    if file_id is not None:
+        try:
+            return context.bot.send_photo(
+                chat_id=chat_id,
+                photo=file_id,
+                caption=caption,
+                reply_markup=reply_markup,
+                parse_mode=ParseMode.MARKDOWN,
+            )
+        except BadRequest as error:
+            logging.error(error)
+            db.delete(photo_key)
+
+    image_url = catalog.get_image_url(image_id)
+    message = context.bot.send_photo(
+        chat_id=chat_id,
+        photo=image_url,
+        caption=caption,
+        reply_markup=reply_markup,
+        parse_mode=ParseMode.MARKDOWN,
+    )
+    db.set(photo_key, message.photo[-1].file_id)
+    return message
+
 
+def build_menu_page(products, chunk, last_chunk):
     keyboard = [
         [InlineKeyboardButton(pr_name, callback_data=pr_id)]
-        for pr_id, pr_name in chunks[chunk]
+        for pr_id, pr_name in products
     ]
     if chunk == 0:
         keyboard.append([InlineKeyboardButton("Следующие", callback_data='next')])
@@ -80,6 +87,13 @@ def create_menu_buttons(chunk):
     return InlineKeyboardMarkup(keyboard)
 
 
+menu_pages = utils.MenuPages(build_menu_page, size=7)
+
+
+def create_menu_buttons(chunk):
+    return menu_pages.get_page(catalog.get_products(), chunk)
+
+
 def create_description_buttons():
     buttons_list = [['1 шт', 'cart 1'], ['3 шт', 'cart 3'], ['5 шт', 'cart 5']]
     keyboard = [
@@ -94,8 +108,7 @@ def create_description_buttons():
     return InlineKeyboardMarkup(keyboard)
 
 
-def create_basket_buttons(user_id=None):
-    user_basket = moltin.get_cart(user_id)
+def create_basket_buttons(user_basket):
     keyboard = []
     for product in user_basket:
         pr_name = product['name']
@@ -111,7 +124,7 @@ def create_basket_buttons(user_id=None):
 
 
 def create_delivery_buttons(distance):
-    if distance <= 20:
+    if utils.get_delivery_price(distance) is not None:
         keyboard = [
             [
                 InlineKeyboardButton('Доставка', callback_data='delivery'),
@@ -123,13 +136,11 @@ def create_delivery_buttons(distance):
     return InlineKeyboardMarkup(keyboard)
 
 
-def start(update, context):
+def start(update, context, session):
     chat_id = update.message.chat_id
     keyboard = create_menu_buttons(chunk=0)
 
-    user_data = json.loads(db.get(chat_id))
-    user_data['last_chunk'] = 0
-    db.set(chat_id, json.dumps(user_data))
+    session['last_chunk'] = 0
 
     context.bot.send_message(
         chat_id=chat_id,
@@ -140,17 +151,17 @@ def start(update, context):
     return 'HANDLE_MENU'
 
 
-def handle_button(update, context):
+def handle_button(update, context, session):
     query = update.callback_query
     chat_id = query.message.chat_id
     message_id = query.message.message_id
 
-    user_data = json.loads(db.get(chat_id))
-    chunk = user_data['last_chunk']
+    chunk = session['last_chunk']
 
     if query.data == 'basket':
-        keyboard = create_basket_buttons(user_id=chat_id)
-        message = moltin.format_basket_for_sending(chat_id)
+        cart = carts.get(chat_id)
+        keyboard = create_basket_buttons(cart['items'])
+        message = moltin.format_basket(cart['items'], cart['total'])
         context.bot.send_message(
             chat_id=chat_id,
             text=message,
@@ -168,8 +179,7 @@ def handle_button(update, context):
             parse_mode=ParseMode.MARKDOWN,
         )
         context.bot.deleteMessage(chat_id=chat_id, message_id=message_id)
-        user_data['last_chunk'] -= 1
-        db.set(chat_id, json.dumps(user_data))
+        session.incr('last_chunk', -1)
         return 'HANDLE_MENU'
     elif query.data == 'next':
         keyboard = create_menu_buttons(chunk=chunk + 1)
@@ -180,48 +190,36 @@ def handle_button(update, context):
             parse_mode=ParseMode.MARKDOWN,
         )
         context.bot.deleteMessage(chat_id=chat_id, message_id=message_id)
-        user_data['last_chunk'] += 1
-        db.set(chat_id, json.dumps(user_data))
+        session.incr('last_chunk')
         return 'HANDLE_MENU'
     else:
-        pizza_data = moltin.get_by_id(query.data)
+        pizza_data = catalog.get_product(query.data)
         pizza_name = pizza_data['name']
         pizza_text = pizza_data['description']
         pizza_price = pizza_data['meta']['display_price']['with_tax']['formatted']
         image_id = pizza_data['relationships']['main_image']['data']['id']
-        image_url = db.get(image_id) or moltin.get_picture(image_id)
-        basket_message = moltin.check_product_in_cart(chat_id, query.data) or ''
+        basket_message = carts.check_product(chat_id, query.data) or ''
 
         keyboard = create_description_buttons()
 
-        user_data = json.loads(db.get(chat_id))
-        user_data['last_product'] = query.data
-        db.set(chat_id, json.dumps(user_data))
+        session['last_product'] = query.data
 
         message = f'*{pizza_name}*\n\n{pizza_text}\n\n_Цена {pizza_price}_\n\n{basket_message}'
-        context.bot.send_photo(
-            chat_id=chat_id,
-            photo=image_url,
-            caption=message,
-            reply_markup=keyboard,
-            parse_mode=ParseMode.MARKDOWN,
-        )
+        send_product_photo(context, chat_id, image_id, message, keyboard)
         context.bot.deleteMessage(chat_id=chat_id, message_id=message_id)
 
     return 'HANDLE_DESCRIPTION'
 
 
-def handle_description(update, context):
+def handle_description(update, context, session):
     query = update.callback_query
     chat_id = query.message.chat_id
     message_id = query.message.message_id
 
-    user_data = json.loads(db.get(chat_id))
-    product_id = user_data['last_product']
+    product_id = session['last_product']
 
     if query.data == 'back_to_menu':
-        user_data = json.loads(db.get(chat_id))
-        chunk = user_data['last_chunk']
+        chunk = session['last_chunk']
         keyboard = create_menu_buttons(chunk=chunk)
         context.bot.send_message(
             chat_id=chat_id,
@@ -232,8 +230,9 @@ def handle_description(update, context):
         context.bot.deleteMessage(chat_id=chat_id, message_id=message_id)
         return 'HANDLE_MENU'
     elif query.data == 'basket':
-        keyboard = create_basket_buttons(user_id=chat_id)
-        message = moltin.format_basket_for_sending(chat_id)
+        cart = carts.get(chat_id)
+        keyboard = create_basket_buttons(cart['items'])
+        message = moltin.format_basket(cart['items'], cart['total'])
         context.bot.send_message(
             chat_id=chat_id,
             text=message,
@@ -244,15 +243,14 @@ def handle_description(update, context):
         return 'HANDLE_BASKET'
     elif query.data.split()[0] == 'cart':
         quantity = int(query.data.split()[1])
-        moltin.put_in_cart(chat_id, product_id, quantity)
-        print(chat_id, product_id)
+        carts.queue_put(chat_id, product_id, quantity)
         context.bot.answer_callback_query(
             callback_query_id=query.id, text='Добавили в корзину!'
         )
         return 'HANDLE_DESCRIPTION'
 
 
-def handle_basket(update, context):
+def handle_basket(update, context, session):
     query = update.callback_query
     chat_id = query.message.chat_id
     message_id = query.message.message_id
@@ -281,9 +279,9 @@ def handle_basket(update, context):
         context.bot.deleteMessage(chat_id=chat_id, message_id=message_id)
         return 'WAITING_GEO'
     else:
-        moltin.delete_item_in_cart(chat_id, query.data)
-        message = moltin.format_basket_for_sending(chat_id)
-        keyboard = create_basket_buttons(user_id=chat_id)
+        cart = carts.delete(chat_id, query.data)
+        message = moltin.format_basket(cart['items'], cart['total'])
+        keyboard = create_basket_buttons(cart['items'])
         context.bot.answer_callback_query(
             callback_query_id=query.id, text='Удалили из корзины!'
         )
@@ -297,12 +295,12 @@ def handle_basket(update, context):
         return 'HANDLE_BASKET'
 
 
-def handle_waiting(update, context):
+def handle_waiting(update, context, session):
     message = update.message
     chat_id = message.chat_id
     if message.text:
         try:
-            current_pos = utils.fetch_coordinates(message.text)
+            current_pos = utils.fetch_coordinates(message.text, db=db)
         except IndexError as error:
             logging.error(error)
             update.message.reply_text(
@@ -315,29 +313,26 @@ def handle_waiting(update, context):
     if current_pos is None:
         return 'WAITING_GEO'
 
-    closest_pizzeria = utils.get_closest_pizzeria(db, current_pos)
+    closest_pizzeria = utils.get_closest_pizzeria(current_pos, db=db)
     message, dist = utils.calculate_distance_for_message(closest_pizzeria)
     update.message.reply_text(
         text='Данные приняты, спасибо.', reply_markup=ReplyKeyboardRemove()
     )
     keyboard = create_delivery_buttons(dist)
     context.bot.send_message(chat_id=chat_id, text=message, reply_markup=keyboard)
-    user_data = json.loads(db.get(chat_id))
-    user_data['closest_pizzeria'] = closest_pizzeria
-    user_data['customer_geo'] = current_pos
-    db.set(chat_id, json.dumps(user_data))
+    session['closest_pizzeria'] = closest_pizzeria
+    session['customer_geo'] = current_pos
     return 'WAITING_CHOOSING'
 
 
-def handle_delivery_choosing(update, context):
+def handle_delivery_choosing(update, context, session):
     query = update.callback_query
     chat_id = query.message.chat_id
     message_id = query.message.message_id
     user_name = query.message.chat.first_name
 
-    user_data = json.loads(db.get(chat_id))
-    closest_pizzeria = user_data['closest_pizzeria']
-    customer_geo = user_data['customer_geo']
+    closest_pizzeria = session['closest_pizzeria']
+    customer_geo = session['customer_geo']
     pizzeria_name = closest_pizzeria['alias']
     pizzeria_address = closest_pizzeria['address']
     pizzeria_id = closest_pizzeria['id']
@@ -379,7 +374,7 @@ def remind_about_order(context):
 
 
 def create_invoice(context, chat_id):
-    user_total = moltin.get_total(chat_id)
+    user_total = carts.get_total(chat_id)
     amount = user_total.split()[0].split('.')[0].replace(',', '')
     title = "Оплата заказа"
     description = "Пожалуйста, нажмите, чтобы оплатить заказ."
@@ -427,16 +422,12 @@ def handle_users_reply(update, context):
     else:
         return
 
+    session = UserSession(db, chat_id)
     if user_reply == '/start':
         user_state = 'START'
+        session.reset(state='START')
     else:
-        user = db.get(chat_id)
-        user_state = json.loads(user)['state']
-
-    if user_state == 'START':
-        user = {}
-        user["state"] = 'START'
-        db.set(chat_id, json.dumps(user))
+        user_state = session['state']
 
     states_functions = {
         'START': start,
@@ -449,27 +440,25 @@ def handle_users_reply(update, context):
 
     state_handler = states_functions[user_state]
     try:
-        next_state = state_handler(update, context)
+        next_state = state_handler(update, context, session)
     except Exception as error:
         logging.exception(error)
         next_state = None
 
     if next_state is not None:
-        user = db.get(chat_id)
-        if user:
-            user_data = json.loads(user)
-            user_data['state'] = next_state
-        else:
-            user_data = {'state': next_state}
-        db.set(chat_id, json.dumps(user_data))
+        session.set_state(next_state)
+    session.save()
 
 
 if __name__ == "__main__":
     load_dotenv()
     tg_token = os.getenv('TG_TOKEN')
 
-    global db
-    db = get_database()
+    global db, catalog, carts
+    db = utils.get_database()
+    catalog = CatalogCache(db)
+    carts = CartMirror(db)
+    catalog.start_listening()
 
     updater = Updater(tg_token, use_context=True)
     dispatcher = updater.dispatcher
@@ -488,3 +477,4 @@ if __name__ == "__main__":
 
     updater.start_polling()
     updater.idle()
+    carts.flush_all()
@@ -1,94 +1,408 @@
+import hashlib
+import heapq
+import json
+import math
 import os
-from operator import itemgetter
+import re
+from urllib.parse import urlencode
 
-import requests
+import numpy
 import redis
 from geopy import Point, distance
 
+import http_client
 import moltin
 from dotenv import load_dotenv
 
 
 def get_database():
     database = redis.Redis(
+        host=os.getenv("REDIS_URL", "localhost"),
+        port=os.getenv("REDIS_PORT", 6379),
+        password=os.getenv("REDIS_PASSWORD"),
         charset="utf-8",
         decode_responses=True,
     )
     return database
 
 
-def get_closest_pizzeria(coordinates, flow_slug="pizzerias", all_pizzerias=None):
+class PizzeriaIndex:
+    """KD-tree over pizzerias placed on the unit sphere.
+
+    Chord length between unit vectors grows with the great-circle distance,
+    so the tree finds the closest entries without calling geopy for each one.
+    The geodesic distance is calculated only for the entries that are returned.
+    """
+
+    def __init__(self, entries):
+        self.entries = list(entries)
+        points = [
+            (to_unit_vector(entry["longitude"], entry["latitude"]), number)
+            for number, entry in enumerate(self.entries)
+        ]
+        self._tree = self._build(points, depth=0)
+        self._radians = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _build(self, points, depth):
+        if not points:
+            return None
+        axis = depth % 3
+        points.sort(key=lambda point: point[0][axis])
+        median = len(points) // 2
+        return (
+            points[median],
+            axis,
+            self._build(points[:median], depth + 1),
+            self._build(points[median + 1:], depth + 1),
+        )
+
+    def _search(self, node, target, k, found):
+        if node is None:
+            return
+        (point, number), axis, left, right = node
+        chord = sum((a - b) ** 2 for a, b in zip(point, target))
+        if len(found) < k:
+            heapq.heappush(found, (-chord, number))
+        elif chord < -found[0][0]:
+            heapq.heapreplace(found, (-chord, number))
+
+        axis_distance = target[axis] - point[axis]
+        near, far = (left, right) if axis_distance < 0 else (right, left)
+        self._search(near, target, k, found)
+        if len(found) < k or axis_distance ** 2 < -found[0][0]:
+            self._search(far, target, k, found)
+
+    def k_nearest(self, coordinates, k=1):
+        target = to_unit_vector(*coordinates)
+        found = []
+        self._search(self._tree, target, k, found)
+        numbers = [number for _, number in sorted(found, reverse=True)]
+        return [
+            describe_pizzeria(self.entries[number], coordinates) for number in numbers
+        ]
+
+    def nearest(self, coordinates):
+        return self.k_nearest(coordinates, k=1)[0]
+
+    @property
+    def radians(self):
+        if self._radians is None:
+            self._radians = numpy.radians(
+                [
+                    (float(entry["longitude"]), float(entry["latitude"]))
+                    for entry in self.entries
+                ]
+            )
+        return self._radians
+
+
+_pizzeria_index = {"fingerprint": None, "index": None}
+
+EARTH_RADIUS_KM = 6371.0088
+DELIVERY_TIERS = ((0.5, 0), (5, 100), (20, 300))
+DELIVERY_MESSAGES = (
+    "Есть ресторан совсем рядом с вами. Доставка бесплатна, или можете забрать заказ самостоятельно, если не хотите ждать, адресс {address}.",
+    "Ближайшая пиццерия всего в {distance} км. Похоже, придется ехать до вас на самокате, стоимость доставки {price} рублей. Доставляем или самовывоз?",
+    "Ваша пиццерия {alias}, стоимость доставки составит {price} рублей.",
+)
+TOO_FAR_MESSAGE = "Простите, так далеко мы не доставляем. Ближайшая к вам пиццерия аж в {distance} км от вас."
+
+YANDEX_MAP_URL = "https://static-maps.yandex.ru/1.x/"
+MAP_ZOOM = 17
+MAP_SIZE = "650,400"
+MAP_PRECISION = 5
+DEFAULT_MAP_CACHE_DIR = ".map_cache"
+
+GEOCODE_STATS_KEY = "geocode_stats"
+GEOCODE_TTL = 30 * 24 * 60 * 60
+GEOCODE_NOT_FOUND_TTL = 60 * 60
+ADDRESS_ABBREVIATIONS = (
+    ("ул", "улица"),
+    ("пр-т", "проспект"),
+    ("просп", "проспект"),
+    ("пер", "переулок"),
+    ("наб", "набережная"),
+    ("пл", "площадь"),
+    ("ш", "шоссе"),
+    ("г", "город"),
+    ("д", "дом"),
+)
+
+
+def to_unit_vector(longitude, latitude):
+    longitude = math.radians(float(longitude))
+    latitude = math.radians(float(latitude))
+    return (
+        math.cos(latitude) * math.cos(longitude),
+        math.cos(latitude) * math.sin(longitude),
+        math.sin(latitude),
+    )
+
+
+def describe_pizzeria(entry, coordinates):
+    pizzeria_point = Point(entry["latitude"], entry["longitude"])
+    coordinates_point = Point(coordinates[1], coordinates[0])
+    return {
+        "alias": entry["pizza-alias"],
+        "address": entry["pizza-address"],
+        "longitude": entry["longitude"],
+        "latitude": entry["latitude"],
+        "distance": distance.distance(pizzeria_point, coordinates_point).km,
+        "id": entry["id"],
+    }
+
+
+def get_pizzeria_index(entries, fingerprint=None):
+    """Return the index for `entries`, rebuilding it only if they have changed."""
+    if fingerprint is None:
+        fingerprint = tuple(
+            (entry["id"], entry["longitude"], entry["latitude"]) for entry in entries
+        )
+    if _pizzeria_index["fingerprint"] != fingerprint:
+        _pizzeria_index["index"] = PizzeriaIndex(entries)
+        _pizzeria_index["fingerprint"] = fingerprint
+    return _pizzeria_index["index"]
+
+
+def load_pizzeria_index(db, flow_slug="pizzerias"):
+    pizzerias = db.get(flow_slug)
+    if pizzerias is None:
+        entries = moltin.get_all_entries(flow_slug)
+        pizzerias = json.dumps(entries)
+        db.set(flow_slug, pizzerias)
+    fingerprint = hashlib.sha1(pizzerias.encode()).hexdigest()
+    if _pizzeria_index["fingerprint"] == fingerprint:
+        return _pizzeria_index["index"]
+    return get_pizzeria_index(json.loads(pizzerias), fingerprint=fingerprint)
+
+
+def find_pizzeria_index(flow_slug="pizzerias", all_pizzerias=None, db=None):
+    if db is not None:
+        return load_pizzeria_index(db, flow_slug)
     entries = all_pizzerias or moltin.get_all_entries(flow_slug)
-    pizzerias = []
-    for entry in entries:
-        pizzeria_name = entry["pizza-alias"]
-        pizzeria_address = entry["pizza-address"]
-        pizzeria_longitude = entry["longitude"]
-        pizzetia_latitude = entry["latitude"]
-        pizzeria_point = Point(pizzetia_latitude, pizzeria_longitude)
-        coordinates_point = Point(coordinates[1], coordinates[0])
-        pizzeria_distance = distance.distance(pizzeria_point, coordinates_point).km
-        pizzeria_id = entry["id"]
-        data = {
-            "alias": pizzeria_name,
-            "address": pizzeria_address,
-            "longitude": pizzeria_longitude,
-            "latitude": pizzetia_latitude,
-            "distance": pizzeria_distance,
-            "id": pizzeria_id,
-        }
-        pizzerias.append(data)
-    closest_pizzeria = min(pizzerias, key=itemgetter("distance"))
-    return closest_pizzeria
+    return get_pizzeria_index(entries)
+
+
+def get_closest_pizzeria(
+    coordinates, flow_slug="pizzerias", all_pizzerias=None, db=None
+):
+    index = find_pizzeria_index(flow_slug, all_pizzerias, db)
+    return index.nearest(coordinates)
+
+
+def get_closest_pizzerias(
+    coordinates, k, flow_slug="pizzerias", all_pizzerias=None, db=None
+):
+    index = find_pizzeria_index(flow_slug, all_pizzerias, db)
+    return index.k_nearest(coordinates, k)
 
 
 def calculate_distance_for_message(pizzeria):
     distance = pizzeria["distance"]
-    alias = pizzeria["alias"]
-    address = pizzeria["address"]
-    if distance <= 0.5:
-        message = f"Есть ресторан совсем рядом с вами. Доставка бесплатна, или можете забрать заказ самостоятельно, если не хотите ждать, адресс {address}."
-    elif 0.5 < distance <= 5:
-        message = f"Ближайшая пиццерия всего в {int(distance)} км. Похоже, придется ехать до вас на самокате, стоимость доставки 100 рублей. Доставляем или самовывоз?"
-    elif 5 < distance <= 20:
-        message = f"Ваша пиццерия {alias}, стоимость доставки составит 300 рублей."
-    else:
-        message = f"Простите, так далеко мы не доставляем. Ближайшая к вам пиццерия аж в {int(distance)} км от вас."
+    tier = get_delivery_tier(distance)
+    template = TOO_FAR_MESSAGE if tier is None else DELIVERY_MESSAGES[tier]
+    message = template.format(
+        address=pizzeria["address"],
+        alias=pizzeria["alias"],
+        distance=int(distance),
+        price=get_delivery_price(distance),
+    )
     return message, int(distance)
 
 
+def get_delivery_tier(distance):
+    """Return the index of the DELIVERY_TIERS entry for `distance`, or None."""
+    for tier, (max_distance, price) in enumerate(DELIVERY_TIERS):
+        if distance <= max_distance:
+            return tier
+    return None
+
+
+def get_delivery_price(distance):
+    """Return delivery price in rubles, or None if the address is too far."""
+    tier = get_delivery_tier(distance)
+    return None if tier is None else DELIVERY_TIERS[tier][1]
+
+
+def calculate_distance_matrix(coordinates, pizzerias_radians):
+    """Haversine distances in km between N (lon, lat) points and M pizzerias."""
+    customers = numpy.radians(numpy.asarray(coordinates, dtype=float).reshape(-1, 2))
+    customer_longitude = customers[:, 0, numpy.newaxis]
+    customer_latitude = customers[:, 1, numpy.newaxis]
+    pizzeria_longitude = pizzerias_radians[numpy.newaxis, :, 0]
+    pizzeria_latitude = pizzerias_radians[numpy.newaxis, :, 1]
+
+    haversine = (
+        numpy.sin((pizzeria_latitude - customer_latitude) / 2) ** 2
+        + numpy.cos(customer_latitude)
+        * numpy.cos(pizzeria_latitude)
+        * numpy.sin((pizzeria_longitude - customer_longitude) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(haversine))
+
+
+def get_closest_pizzerias_for_many(
+    coordinates, flow_slug="pizzerias", all_pizzerias=None, db=None
+):
+    """Find the closest pizzeria for every (lon, lat) pair in one NumPy pass.
+
+    Returns one dict per row in the same format as get_closest_pizzeria, with
+    a `delivery_price` key added (None when delivery is not available).
+    """
+    index = find_pizzeria_index(flow_slug, all_pizzerias, db)
+    if not len(coordinates):
+        return []
+    distances = calculate_distance_matrix(coordinates, index.radians)
+    closest = distances.argmin(axis=1)
+    closest_distances = distances[numpy.arange(len(closest)), closest]
+
+    pizzerias = []
+    for number, pizzeria_distance in zip(closest, closest_distances):
+        entry = index.entries[number]
+        pizzerias.append(
+            {
+                "alias": entry["pizza-alias"],
+                "address": entry["pizza-address"],
+                "longitude": entry["longitude"],
+                "latitude": entry["latitude"],
+                "distance": float(pizzeria_distance),
+                "id": entry["id"],
+                "delivery_price": get_delivery_price(pizzeria_distance),
+            }
+        )
+    return pizzerias
+
+
+def get_telegram_photo_key(bot_token, image_id):
+    bot_id = bot_token.split(":")[0]
+    return f"tg_photo_{bot_id}_{image_id}"
+
+
+class MenuPages:
+    """Prebuilt menu keyboards, one per page of products.
+
+    Pages are rebuilt only when a different products list is passed in, i.e.
+    after the catalog cache has dropped and reloaded it.
+    """
+
+    def __init__(self, build_page, size):
+        self.build_page = build_page
+        self.size = size
+        self._built = (None, [])
+
+    def get_page(self, products, number):
+        built_for, pages = self._built
+        if products is not built_for:
+            chunks = list(create_chunks(products, size=self.size))
+            last_chunk = len(chunks) - 1
+            pages = [
+                self.build_page(chunk, chunk_number, last_chunk)
+                for chunk_number, chunk in enumerate(chunks)
+            ]
+            self._built = (products, pages)
+        return pages[number]
+
+
 def create_chunks(products, size=7):
     for i in range(0, len(products), size):
         yield products[i: i + size]
 
 
-def get_yandex_map(locations):
-    url = "https://static-maps.yandex.ru/1.x/"
+def get_yandex_map(locations, zoom=MAP_ZOOM, size=MAP_SIZE):
+    longitude, latitude = (
+        round(float(coordinate), MAP_PRECISION) for coordinate in locations
+    )
     params = {
         "l": "map",
-        "ll": f"{locations[0]},{locations[1]}",
-        "size": "650,400",
-        "z": 17,
-        "pt": f"{locations[0]},{locations[1]},comma",
+        "ll": f"{longitude},{latitude}",
+        "size": size,
+        "z": zoom,
+        "pt": f"{longitude},{latitude},comma",
         "scale": 1,
     }
-    response = requests.get(url=url, params=params)
-    response.raise_for_status()
-    return response.url
+    return f"{YANDEX_MAP_URL}?{urlencode(params, safe=',')}"
+
+
+def get_map_image(locations, zoom=MAP_ZOOM, size=MAP_SIZE):
+    """Return map image content, downloading it once per rounded location."""
+    map_url = get_yandex_map(locations, zoom=zoom, size=size)
+    cache_dir = os.getenv("MAP_CACHE_DIR", DEFAULT_MAP_CACHE_DIR)
+    image_name = hashlib.sha1(map_url.encode()).hexdigest()
+    image_path = os.path.join(cache_dir, f"{image_name}.png")
+    try:
+        with open(image_path, "rb") as image_file:
+            return image_file.read()
+    except FileNotFoundError:
+        pass
+
+    content = http_client.get(map_url).content
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_path = f"{image_path}.{os.getpid()}.tmp"
+    with open(temp_path, "wb") as image_file:
+        image_file.write(content)
+    os.replace(temp_path, image_path)
+    return content
+
+
+def normalize_address(place):
+    address = place.lower().replace("ё", "е")
+    address = re.sub(r"[,;]", " ", address)
+    for abbreviation, full_name in ADDRESS_ABBREVIATIONS:
+        pattern = rf"\b{re.escape(abbreviation)}(?:\.|(?=\s|$))"
+        address = re.sub(pattern, f"{full_name} ", address)
+    return " ".join(address.split())
 
 
-def fetch_coordinates(place):
+def request_coordinates(place):
     apikey = os.getenv('YANDEX_API_KEY')
     base_url = "https://geocode-maps.yandex.ru/1.x"
     params = {"geocode": place, "apikey": apikey, "format": "json"}
-    response = requests.get(base_url, params=params)
-    response.raise_for_status()
+    response = http_client.get(base_url, params=params)
     places_found = response.json()['response']['GeoObjectCollection']['featureMember']
     most_relevant = places_found[0]
     lon, lat = most_relevant['GeoObject']['Point']['pos'].split(" ")
     return lon, lat
 
 
+def fetch_coordinates(place, db=None):
+    """Geocode `place`, caching found and not found addresses in Redis.
+
+    Raises IndexError when Yandex can't find the address, as before.
+    """
+    if db is None:
+        return request_coordinates(place)
+
+    key = f"geocode_{normalize_address(place)}"
+    cached = db.get(key)
+    if cached is not None:
+        db.hincrby(GEOCODE_STATS_KEY, "hits")
+        if not cached:
+            raise IndexError(f"Address not found: {place}")
+        return tuple(json.loads(cached))
+
+    db.hincrby(GEOCODE_STATS_KEY, "misses")
+    try:
+        coordinates = request_coordinates(place)
+    except IndexError:
+        db.set(key, "", ex=GEOCODE_NOT_FOUND_TTL)
+        raise
+    db.set(key, json.dumps(coordinates), ex=GEOCODE_TTL)
+    return coordinates
+
+
+def get_geocode_stats(db):
+    stats = {"hits": 0, "misses": 0}
+    stats.update(
+        {field: int(value) for field, value in db.hgetall(GEOCODE_STATS_KEY).items()}
+    )
+    requests_count = stats["hits"] + stats["misses"]
+    stats["hit_ratio"] = stats["hits"] / requests_count if requests_count else 0
+    return stats
+
+
 if __name__ == "__main__":
     load_dotenv()
     db = get_database()
@@ -1,44 +1,32 @@
 import json
 import logging
 import os
-from io import BytesIO
 from json.decoder import JSONDecodeError
 
 import requests
 import vk_api
 from dotenv import load_dotenv
-from vk_api import VkUpload
 from vk_api.exceptions import ApiError
 from vk_api.keyboard import VkKeyboard, VkKeyboardColor
 from vk_api.longpoll import VkEventType, VkLongPoll
 from vk_api.utils import get_random_id
 
-import moltin
+import photos
 import utils
+from cart_mirror import CartMirror
+from catalog import CatalogCache
+from sessions import UserSession
+from worker_pool import DEFAULT_QUEUE_SIZE, DEFAULT_WORKERS, OrderedWorkerPool
 
 VK_GRROUP_ID = 6976575
 PAYEE = 91623053
+DEFAULT_STATS_INTERVAL = 300
 
 
-def upload_photo_for_message(vk, image_url):
-    upload = VkUpload(vk)
-
-    attachment = []
-    image_content = requests.get(image_url)
-    image_content.raise_for_status()
-    file_obj = BytesIO(image_content.content)
-    photo = upload.photo_messages(file_obj)[0]
-    attachment.append("photo{}_{}".format(photo["owner_id"], photo["id"]))
-    return attachment
-
-
-def create_menu_buttons(chunk):
-    products = moltin.get_products()
-    chunks = list(utils.create_chunks(products, size=5))
-    last_chunk = len(chunks) - 1
+def build_menu_page(products, chunk, last_chunk):
     keyboard = VkKeyboard(one_time=True)
 
-    for product in chunks[chunk]:
+    for product in products:
         slug, name = product
         keyboard.add_button(name, payload=json.dumps(slug))
         keyboard.add_line()
@@ -56,6 +44,13 @@ def create_menu_buttons(chunk):
     return keyboard.get_keyboard()
 
 
+menu_pages = utils.MenuPages(build_menu_page, size=5)
+
+
+def create_menu_buttons(chunk):
+    return menu_pages.get_page(catalog.get_products(), chunk)
+
+
 def create_description_buttons():
     buttons_list = [["1 шт", "cart 1"], ["3 шт", "cart 3"], ["5 шт", "cart 5"]]
     keyboard = VkKeyboard()
@@ -72,8 +67,7 @@ def create_description_buttons():
     return keyboard.get_keyboard()
 
 
-def create_basket_buttons(user_id=None):
-    user_basket = moltin.get_cart(user_id)
+def create_basket_buttons(user_basket):
     keyboard = VkKeyboard()
     for product in user_basket:
         pr_name = product["name"]
@@ -92,7 +86,7 @@ def create_basket_buttons(user_id=None):
 
 def create_delivery_buttons(distance):
     keyboard = VkKeyboard()
-    if distance <= 20:
+    if utils.get_delivery_price(distance) is not None:
         keyboard.add_button("Доставка", payload=json.dumps("delivery"))
         keyboard.add_line()
         keyboard.add_button("Самовывоз", payload=json.dumps("pickup"))
@@ -118,13 +112,11 @@ def create_payment_buttons(amount, recipient=PAYEE):
     return keyboard.get_keyboard()
 
 
-def start(event, vk):
+def start(event, vk, session):
     user_id = event.user_id
     keyboard = create_menu_buttons(chunk=0)
 
-    user_data = json.loads(db.get(f"vk_{user_id}"))
-    user_data["last_chunk"] = 0
-    db.set(f"vk_{user_id}", json.dumps(user_data))
+    session["last_chunk"] = 0
 
     vk.messages.send(
         user_id=user_id,
@@ -135,15 +127,15 @@ def start(event, vk):
     return "HANDLE_MENU"
 
 
-def handle_button(event, vk):
+def handle_button(event, vk, session):
     payload = json.loads(event.payload)
     user_id = event.user_id
-    user_data = json.loads(db.get(f"vk_{user_id}"))
-    chunk = user_data["last_chunk"]
+    chunk = session["last_chunk"]
 
     if payload == "basket":
-        total = moltin.get_total(user_id)
-        keyboard = create_basket_buttons(user_id)
+        cart = carts.get(user_id)
+        total = cart["total"]
+        keyboard = create_basket_buttons(cart["items"])
         vk.messages.send(
             user_id=user_id,
             message=f"В корзине пицц на {total}",
@@ -159,8 +151,7 @@ def handle_button(event, vk):
             random_id=get_random_id(),
             keyboard=keyboard,
         )
-        user_data["last_chunk"] += 1
-        db.set(f"vk_{user_id}", json.dumps(user_data))
+        session.incr("last_chunk")
         return "HANDLE_MENU"
     elif payload == "prev":
         keyboard = create_menu_buttons(chunk=chunk - 1)
@@ -170,23 +161,19 @@ def handle_button(event, vk):
             random_id=get_random_id(),
             keyboard=keyboard,
         )
-        user_data["last_chunk"] -= 1
-        db.set(f"vk_{user_id}", json.dumps(user_data))
+        session.incr("last_chunk", -1)
         return "HANDLE_MENU"
     else:
-        pizza_data = json.loads(db.get(payload)) or moltin.get_by_id(payload)
+        pizza_data = catalog.get_product(payload)
         pizza_name = pizza_data["name"]
         pizza_text = pizza_data["description"]
         pizza_price = pizza_data["meta"]["display_price"]["with_tax"]["formatted"]
         image_id = pizza_data["relationships"]["main_image"]["data"]["id"]
-        image_url = db.get(image_id) or moltin.get_picture(image_id)
 
-        user_data = json.loads(db.get(f'vk_{user_id}'))
-        user_data['last_product'] = payload
-        db.set(f'vk_{user_id}', json.dumps(user_data))
+        session["last_product"] = payload
 
         try:
-            attachments = upload_photo_for_message(vk, image_url)
+            attachments = photos.get_photo_attachment(db, vk, image_id)
         except (requests.HTTPError, requests.ConnectionError, ApiError) as error:
             attachments = []
             logging.exception(error)
@@ -203,15 +190,14 @@ def handle_button(event, vk):
         return "HANDLE_DESCRIPTION"
 
 
-def handle_description(event, vk):
+def handle_description(event, vk, session):
     try:
         payload = json.loads(event.payload)
     except AttributeError:
         return "HANDLE_DESCRIPTION"
     user_id = event.user_id
-    user_data = json.loads(db.get(f"vk_{user_id}"))
-    chunk = user_data["last_chunk"]
-    product_id = user_data["last_product"]
+    chunk = session["last_chunk"]
+    product_id = session["last_product"]
     keyboard = VkKeyboard().get_empty_keyboard()
     vk.messages.send(
         user_id=user_id, message="Принято", random_id=get_random_id(), keyboard=keyboard
@@ -227,8 +213,9 @@ def handle_description(event, vk):
         )
         return "HANDLE_MENU"
     elif payload == "basket":
-        total = moltin.get_total(user_id)
-        keyboard = create_basket_buttons(user_id)
+        cart = carts.get(user_id)
+        total = cart["total"]
+        keyboard = create_basket_buttons(cart["items"])
         vk.messages.send(
             user_id=user_id,
             message=f"В корзине пицц на {total}",
@@ -238,7 +225,7 @@ def handle_description(event, vk):
         return "HANDLE_BASKET"
     elif payload.split()[0] == "cart":
         quantity = int(payload.split()[1])
-        moltin.put_in_cart(user_id, product_id, quantity)
+        carts.queue_put(user_id, product_id, quantity)
         keyboard = VkKeyboard().get_empty_keyboard()
         vk.messages.send(
             user_id=user_id,
@@ -255,14 +242,13 @@ def handle_description(event, vk):
         return "HANDLE_MENU"
 
 
-def handle_basket(event, vk):
+def handle_basket(event, vk, session):
     try:
         payload = json.loads(event.payload)
     except AttributeError:
         return "HANDLE_DESCRIPTION"
     user_id = event.user_id
-    user_data = json.loads(db.get(f"vk_{user_id}"))
-    chunk = user_data["last_chunk"]
+    chunk = session["last_chunk"]
     keyboard = VkKeyboard().get_empty_keyboard()
     vk.messages.send(
         user_id=user_id, message="Принято", random_id=get_random_id(), keyboard=keyboard
@@ -284,9 +270,9 @@ def handle_basket(event, vk):
         )
         return "HANDLE_GEO"
     else:
-        moltin.delete_item_in_cart(user_id, product_id=payload)
-        keyboard = create_basket_buttons(user_id)
-        total = moltin.get_total(user_id)
+        cart = carts.delete(user_id, payload)
+        keyboard = create_basket_buttons(cart["items"])
+        total = cart["total"]
         vk.messages.send(
             user_id=user_id,
             message=f"В корзине пицц на {total}",
@@ -296,12 +282,12 @@ def handle_basket(event, vk):
         return "HANDLE_BASKET"
 
 
-def handle_locations(event, vk):
+def handle_locations(event, vk, session):
     message = event.text
     user_id = event.user_id
 
     try:
-        current_pos = utils.fetch_coordinates(message)
+        current_pos = utils.fetch_coordinates(message, db=db)
     except IndexError as error:
         logging.error(error)
         vk.messages.send(
@@ -314,33 +300,30 @@ def handle_locations(event, vk):
     if current_pos is None:
         return "HANDLE_GEO"
 
-    closest_pizzeria = utils.get_closest_pizzeria(current_pos)
+    closest_pizzeria = utils.get_closest_pizzeria(current_pos, db=db)
 
     message, dist = utils.calculate_distance_for_message(closest_pizzeria)
     keyboard = create_delivery_buttons(distance=dist)
     vk.messages.send(
         user_id=user_id, message=message, random_id=get_random_id(), keyboard=keyboard
     )
-    user_data = json.loads(db.get(f"vk_{user_id}"))
-    user_data["closest_pizzeria"] = closest_pizzeria
-    user_data["customer_geo"] = current_pos
-    db.set(f"vk_{user_id}", json.dumps(user_data))
+    session["closest_pizzeria"] = closest_pizzeria
+    session["customer_geo"] = current_pos
     return "HANDLE_DELIVERY"
 
 
-def handle_delivery(event, vk):
+def handle_delivery(event, vk, session):
     try:
         payload = json.loads(event.payload)
     except AttributeError:
         return "HANDLE_DELIVERY"
     user_id = event.user_id
 
-    user_data = json.loads(db.get(f"vk_{user_id}"))
-    closest_pizzeria = user_data["closest_pizzeria"]
+    closest_pizzeria = session["closest_pizzeria"]
     pizzeria_name = closest_pizzeria["alias"]
     pizzeria_address = closest_pizzeria["address"]
-    customer_geo = user_data["customer_geo"]
-    user_total = moltin.get_total(user_id)
+    customer_geo = session["customer_geo"]
+    user_total = carts.get_total(user_id)
     amount = user_total.split()[0].split(".")[0].replace(",", "")
 
     keyboard = VkKeyboard().get_empty_keyboard()
@@ -352,11 +335,10 @@ def handle_delivery(event, vk):
     )
 
     if payload in ["pickup"]:
-        locations = utils.fetch_coordinates(pizzeria_address)
-        pizza_map = utils.get_yandex_map(locations)
+        locations = (closest_pizzeria["longitude"], closest_pizzeria["latitude"])
         keyboard = create_payment_buttons(amount)
         try:
-            attachments = upload_photo_for_message(vk, pizza_map)
+            attachments = photos.upload_photo_content(vk, utils.get_map_image(locations))
         except (requests.HTTPError, requests.ConnectionError, ApiError) as error:
             attachments = []
             logging.exception(error)
@@ -372,10 +354,9 @@ def handle_delivery(event, vk):
         return "HANDLE_PAYMENT"
 
     elif payload == "delivery":
-        pizza_map = utils.get_yandex_map(customer_geo)
         keyboard = create_payment_buttons(amount)
         try:
-            attachments = upload_photo_for_message(vk, pizza_map)
+            attachments = photos.upload_photo_content(vk, utils.get_map_image(customer_geo))
         except (requests.HTTPError, requests.ConnectionError, ApiError) as error:
             attachments = []
             logging.exception(error)
@@ -391,7 +372,7 @@ def handle_delivery(event, vk):
         return "HANDLE_PAYMENT"
 
 
-def handle_payment(event, vk):
+def handle_payment(event, vk, session):
     user_id = event.user_id
     try:
         payload = json.loads(event.payload)
@@ -436,22 +417,20 @@ def handle_user_reply(event, vk):
     else:
         return
 
+    session = UserSession(db, f"vk_{user_id}")
     if type(user_reply) is dict:
         user_state = "START"
     elif user_reply.lower().strip() in ["начать", "старт", "start"]:
         user_state = "START"
     else:
-        user = db.get(f"vk_{user_id}")
         try:
-            user_state = json.loads(user)["state"]
-        except (TypeError, JSONDecodeError) as error:
+            user_state = session["state"]
+        except (KeyError, JSONDecodeError) as error:
             logging.exception(error)
             user_state = None
 
     if user_state == 'START':
-        user = {}
-        user["state"] = 'START'
-        db.set(f"vk_{user_id}", json.dumps(user))
+        session.reset(state='START')
 
     states_functions = {
         "START": start,
@@ -465,32 +444,40 @@ def handle_user_reply(event, vk):
     state_handler = states_functions.get(user_state)
 
     try:
-        next_state = state_handler(event, vk)
+        next_state = state_handler(event, vk, session)
     except Exception as error:
         logging.exception(error)
         next_state = None
 
-    if next_state is None:
-        return
-
-    user = db.get(f"vk_{user_id}")
-    if user is not None:
-        user_data = json.loads(user)
-        user_data["state"] = next_state
-    else:
-        user_data = {"state": next_state}
-    db.set(f"vk_{user_id}", json.dumps(user_data))
+    if next_state is not None:
+        session.set_state(next_state)
+    session.save()
 
 
 if __name__ == "__main__":
     load_dotenv()
 
-    global db
+    global db, catalog, carts
     db = utils.get_database()
+    catalog = CatalogCache(db)
+    carts = CartMirror(db)
+    catalog.start_listening()
 
     vk_session = vk_api.VkApi(token=os.getenv("VK_TOKEN"))
     vk = vk_session.get_api()
     longpoll = VkLongPoll(vk_session)
-    for event in longpoll.listen():
-        if event.type == VkEventType.MESSAGE_NEW and event.to_me:
-            handle_user_reply(event, vk)
+
+    workers = OrderedWorkerPool(
+        handle_user_reply,
+        workers=int(os.getenv("VK_WORKERS", DEFAULT_WORKERS)),
+        queue_size=int(os.getenv("VK_QUEUE_SIZE", DEFAULT_QUEUE_SIZE)),
+    )
+    workers.start()
+    workers.log_stats_every(int(os.getenv("VK_STATS_INTERVAL", DEFAULT_STATS_INTERVAL)))
+    try:
+        for event in longpoll.listen():
+            if event.type == VkEventType.MESSAGE_NEW and event.to_me:
+                workers.submit(event.user_id, event, vk)
+    finally:
+        workers.stop()
+        carts.flush_all()
@@ -0,0 +1,84 @@
+import logging
+import queue
+import threading
+import time
+
+DEFAULT_WORKERS = 8
+DEFAULT_QUEUE_SIZE = 100
+
+
+class OrderedWorkerPool:
+    """Runs `handler` on a pool of threads, keeping the order per key.
+
+    Every key is hashed onto one worker with its own bounded queue, so tasks
+    for the same key run one after another in submission order, while tasks
+    for different keys run in parallel. When a worker's queue is full,
+    submit() blocks, which stops the producer from reading more events.
+    """
+
+    def __init__(self, handler, workers=DEFAULT_WORKERS, queue_size=DEFAULT_QUEUE_SIZE):
+        self.handler = handler
+        self._queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = []
+        self._lock = threading.Lock()
+        self._stats = {'submitted': 0, 'processed': 0, 'failed': 0, 'full_waits': 0}
+        self._max_depths = [0] * workers
+
+    def start(self):
+        for number, tasks in enumerate(self._queues):
+            thread = threading.Thread(
+                target=self._work, args=(tasks,), name=f'worker-{number}', daemon=True
+            )
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        for tasks in self._queues:
+            tasks.put(None)
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, key, *args):
+        number = hash(key) % len(self._queues)
+        tasks = self._queues[number]
+        try:
+            tasks.put_nowait(args)
+        except queue.Full:
+            self._count('full_waits')
+            tasks.put(args)
+        with self._lock:
+            self._stats['submitted'] += 1
+            self._max_depths[number] = max(self._max_depths[number], tasks.qsize())
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def _work(self, tasks):
+        while True:
+            args = tasks.get()
+            if args is None:
+                return
+            try:
+                self.handler(*args)
+            except Exception as error:
+                logging.exception(error)
+                self._count('failed')
+            finally:
+                self._count('processed')
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['max_depths'] = list(self._max_depths)
+        stats['depths'] = [tasks.qsize() for tasks in self._queues]
+        return stats
+
+    def log_stats_every(self, interval):
+        def report():
+            while True:
+                time.sleep(interval)
+                logging.info('Worker pool: %s', self.get_stats())
+
+        threading.Thread(target=report, name='worker-stats', daemon=True).start()
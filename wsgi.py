@@ -1,4 +1,16 @@
+from dotenv import load_dotenv
+
+import fb_bot
+import utils
+from cart_mirror import CartMirror
+from catalog import CatalogCache
 from fb_bot import app
 
+load_dotenv()
+fb_bot.db = utils.get_database()
+fb_bot.catalog = CatalogCache(fb_bot.db)
+fb_bot.catalog.start_listening()
+fb_bot.carts = CartMirror(fb_bot.db)
+
 if __name__ == "__main__":
     app.run()